@@ -0,0 +1,362 @@
+"""
+Benchmark of the main stages of the pipeline on a corpus of synthetic reports.
+
+Synthetic reports are PDFs generated from scratch with the same layout of ISS
+reports relevant to the extraction: some pages of filler text and, in one page,
+the table caption followed by the table (including the row of totals).
+
+For each stage, the wall time and the peak memory (of Python allocations,
+measured in a separate run with tracemalloc) are reported and written to a JSON
+file, which can be passed to --compare in a later run to detect regressions::
+
+    python benchmark.py -n 100 --output bench-before.json
+    python benchmark.py -n 100 --compare bench-before.json
+
+The import time of update_data.py is measured as well; the benchmark fails if
+update_data imports any of import_timing.HEAVY_MODULES, which are needed only
+when there are new reports.
+"""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import date, timedelta
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Tuple
+)
+
+import numpy
+import pandas as pd
+
+from file_index import FileIndex
+from import_timing import measure_import
+from settings import PROJECT_DIR, get_single_date_dataset_path
+from table_extraction.common import (
+    find_table_page,
+    recompute_derived_columns,
+    recompute_derived_columns_batch
+)
+from table_extraction.pypdf_extractor import PyPDFTableExtractor
+from table_extraction.stream_extractor import ContentStreamTableExtractor
+
+AGE_GROUPS = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59',
+              '60-69', '70-79', '80-89', '>=90', 'Età non nota']
+TABLE_CAPTION = 'Tabella 1 - Distribuzione dei casi diagnosticati per sesso e per fascia di età '
+
+PAGE_SIZE = (842, 595)  # landscape A4 (points)
+TABLE_TOP = 500  # baseline of the first row (from the bottom of the page)
+ROW_HEIGHT = 15
+COLUMN_X = [40] + [110 + 48 * j for j in range(15)]
+# Tabula area (top, left, bottom, right) measured from the top-left corner
+TABLE_AREA = (PAGE_SIZE[1] - TABLE_TOP - 12, 30,
+              PAGE_SIZE[1] - TABLE_TOP + ROW_HEIGHT * 11 + 8, PAGE_SIZE[0] - 20)
+
+
+# =============================================================================
+# Synthetic reports
+# =============================================================================
+def _format_int(n: int) -> str:
+    return f'{n:,}'.replace(',', '.')
+
+
+def _format_float(x: float) -> str:
+    return f'{x:.1f}'.replace('.', ',')
+
+
+def _fields(cases, deaths, total_cases, total_deaths) -> List[str]:
+    return [
+        _format_int(cases),
+        _format_float(cases / total_cases * 100),
+        _format_int(deaths),
+        _format_float(deaths / total_deaths * 100),
+        _format_float(deaths / cases * 100),
+    ]
+
+
+def synthetic_table_rows(rng: numpy.random.Generator) -> List[List[str]]:
+    """ Returns the 11 rows of the table plus the row of totals, as strings """
+    male_cases = rng.integers(100, 20000, size=11)
+    female_cases = rng.integers(100, 20000, size=11)
+    male_deaths = (male_cases * rng.uniform(0, 0.3, size=11)).astype(int)
+    female_deaths = (female_cases * rng.uniform(0, 0.3, size=11)).astype(int)
+    unknown_sex_cases = rng.integers(0, 50, size=11)
+    cases = male_cases + female_cases + unknown_sex_cases
+    deaths = male_deaths + female_deaths
+
+    rows = []
+    for i in range(12):
+        if i < 11:
+            mc, fc, c = male_cases[i], female_cases[i], cases[i]
+            md, fd, d = male_deaths[i], female_deaths[i], deaths[i]
+            row = [AGE_GROUPS[i]]
+        else:
+            mc, fc, c = male_cases.sum(), female_cases.sum(), cases.sum()
+            md, fd, d = male_deaths.sum(), female_deaths.sum(), deaths.sum()
+            row = ['Totale']
+        row += _fields(mc, md, mc + fc, md + fd)
+        row += _fields(fc, fd, mc + fc, md + fd)
+        row += _fields(c, d, cases.sum(), deaths.sum())
+        rows.append(row)
+    return rows
+
+
+def _pdf_string(text: str) -> bytes:
+    escaped = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return b'(' + escaped.encode('cp1252') + b')'
+
+
+def _text_op(x, y, text) -> bytes:
+    # Each cell is drawn by a separate Tj; the trailing space separates the
+    # tokens in the text returned by PyPDF3 (that doesn't add any separator)
+    return b'1 0 0 1 %d %d Tm %s Tj' % (x, y, _pdf_string(text + ' '))
+
+
+def _page_content(rows=None, filler_lines=40) -> bytes:
+    ops = [b'BT', b'/F1 8 Tf']
+    if rows is None:
+        for i in range(filler_lines):
+            ops.append(_text_op(40, PAGE_SIZE[1] - 40 - 12 * i,
+                                'Lorem ipsum dolor sit amet, consectetur adipiscing elit %d' % i))
+    else:
+        ops.append(_text_op(40, TABLE_TOP + 30, TABLE_CAPTION))
+        for i, row in enumerate(rows):
+            for x, cell in zip(COLUMN_X, row):
+                ops.append(_text_op(x, TABLE_TOP - ROW_HEIGHT * i, cell))
+    ops.append(b'ET')
+    return b'\n'.join(ops)
+
+
+def write_synthetic_report(path: Path, rows, num_pages=20, table_page=10):
+    """ Writes a PDF with the table in the given (1-based) page """
+    objects = []
+
+    def add(obj: bytes) -> int:
+        objects.append(obj)
+        return len(objects)
+
+    font_id = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+                  b'/Encoding /WinAnsiEncoding >>')
+    pages_id = add(b'')  # placeholder
+    page_ids = []
+    for number in range(1, num_pages + 1):
+        content = zlib.compress(_page_content(rows if number == table_page else None))
+        content_id = add(b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream'
+                         % (len(content), content))
+        page_ids.append(add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 %d 0 R >> >> >>'
+            % (pages_id, *PAGE_SIZE, content_id, font_id)))
+    kids = b' '.join(b'%d 0 R' % i for i in page_ids)
+    objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(page_ids))
+    catalog_id = add(b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (i, obj)
+    xref_offset = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += (b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (len(objects) + 1, catalog_id, xref_offset))
+    Path(path).write_bytes(out)
+
+
+def make_synthetic_corpus(dirpath: Path, num_reports: int, num_pages=20,
+                          seed=0) -> List[Tuple[str, Path]]:
+    """ Writes num_reports reports named like real ones; returns (date, path) pairs """
+    rng = numpy.random.default_rng(seed)
+    dirpath.mkdir(parents=True, exist_ok=True)
+    first_date = date(2020, 3, 12)
+    reports = []
+    for i in range(num_reports):
+        report_date = (first_date + timedelta(days=i)).isoformat()
+        path = Path(dirpath, f'{report_date}.pdf')
+        table_page = int(rng.integers(2, num_pages + 1))
+        write_synthetic_report(path, synthetic_table_rows(rng), num_pages, table_page)
+        reports.append((report_date, path))
+    return reports
+
+
+def write_synthetic_tabula_template(dirpath: Path, first_date='2020-01-01'):
+    top, left, bottom, right = TABLE_AREA
+    template = [{'page': 1, 'extraction_method': 'guess',
+                 'x1': left, 'x2': right, 'y1': top, 'y2': bottom,
+                 'width': right - left, 'height': bottom - top}]
+    dirpath.mkdir(parents=True, exist_ok=True)
+    Path(dirpath, f'{first_date}.tabula-template.json').write_text(json.dumps(template))
+
+
+# =============================================================================
+# Benchmark
+# =============================================================================
+def _measure(fn: Callable[[], None], memory=True) -> Dict[str, float]:
+    start = time.perf_counter()
+    fn()
+    result = {'seconds': time.perf_counter() - start}
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _tabula_extractor(workdir: Path):
+    """ Returns a TabulaTableExtractor or None if tabula or java are not available """
+    try:
+        from table_extraction.tabula_extractor import TabulaTableExtractor
+    except ImportError:
+        return None
+    if shutil.which('java') is None:
+        return None
+    template_dir = Path(workdir, 'tabula-templates')
+    write_synthetic_tabula_template(template_dir)
+    return TabulaTableExtractor(template_dir)
+
+
+def define_stages(workdir: Path, reports: List[Tuple[str, Path]],
+                  with_tabula=True) -> Dict[str, Callable[[], None]]:
+    from make_datasets import make_full_dataset
+
+    pypdf_extractor = PyPDFTableExtractor()
+    stream_extractor = ContentStreamTableExtractor()
+    tables = [pypdf_extractor(path, report_date) for report_date, path in reports]
+    by_date_dir = Path(workdir, 'by-date')
+    by_date_dir.mkdir(parents=True, exist_ok=True)
+    for (report_date, _), table in zip(reports, tables):
+        out_path = get_single_date_dataset_path(report_date, dirpath=by_date_dir)
+        recompute_derived_columns(table).to_csv(out_path, index=False)
+
+    stacked_tables = pd.concat([table.set_index('age_group') for table in tables],
+                               keys=[d for d, _ in reports], names=['date', 'age_group'])
+
+    warm_page_index = FileIndex(Path(workdir, 'table-pages.json'))
+    for _, path in reports:
+        find_table_page(path, warm_page_index)
+
+    stages = {
+        'find_table_page': lambda: [find_table_page(path) for _, path in reports],
+        'find_table_page[warm index]':
+            lambda: [find_table_page(path, warm_page_index) for _, path in reports],
+        'PyPDFTableExtractor.extract':
+            lambda: [pypdf_extractor.extract(path, d) for d, path in reports],
+        'ContentStreamTableExtractor.extract':
+            lambda: [stream_extractor.extract(path, d) for d, path in reports],
+        'recompute_derived_columns':
+            lambda: [recompute_derived_columns(table) for table in tables],
+        'recompute_derived_columns_batch': lambda: recompute_derived_columns_batch(stacked_tables),
+        'make_full_dataset': lambda: make_full_dataset(
+            by_date_dir, Path(workdir, 'full'),
+            manifest_path=Path(workdir, 'manifest.json'),
+            feather_path=Path(workdir, 'full.feather'),
+            digest_index=FileIndex(Path(workdir, 'digests.json'))),
+    }
+    tabula_extractor = _tabula_extractor(workdir) if with_tabula else None
+    if tabula_extractor is not None:
+        stages['TabulaTableExtractor.extract'] = \
+            lambda: [tabula_extractor.extract(path, d) for d, path in reports]
+    return stages
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(num_reports=50, num_pages=20, memory=True, with_tabula=True,
+                  workdir=None) -> Dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(workdir or tmpdir)
+        reports = make_synthetic_corpus(Path(workdir, 'reports'), num_reports, num_pages)
+        stages = define_stages(workdir, reports, with_tabula=with_tabula)
+        results = {}
+        for name, fn in stages.items():
+            print(f'Running {name} ...', end=' ', flush=True)
+            results[name] = _measure(fn, memory=memory)
+            results[name]['seconds_per_report'] = results[name]['seconds'] / num_reports
+            print('%.3fs' % results[name]['seconds'])
+
+    print('Running import update_data ...', end=' ', flush=True)
+    results['import update_data'] = measure_import('update_data')
+    print('%.3fs' % results['import update_data']['seconds'])
+
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'num_reports': num_reports,
+            'num_pages': num_pages,
+        },
+        'stages': results,
+    }
+
+
+def print_results(results: Dict, baseline: Dict = None):
+    header = f'{"stage":<36} {"time (s)":>10} {"s/report":>10} {"peak mem (KiB)":>15}'
+    if baseline:
+        header += f' {"time ratio":>11}'
+    print(header)
+    print('-' * len(header))
+    for name, stage in results['stages'].items():
+        peak = stage.get('peak_memory_bytes')
+        per_report = stage.get('seconds_per_report')
+        line = '{:<36} {:>10.3f} {:>10} {:>15}'.format(
+            name, stage['seconds'],
+            '-' if per_report is None else '{:.4f}'.format(per_report),
+            '-' if peak is None else '{:.0f}'.format(peak / 1024))
+        if baseline:
+            old = baseline['stages'].get(name)
+            line += ' {:>11}'.format(
+                '-' if old is None else '{:.2f}'.format(stage['seconds'] / old['seconds']))
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--num-reports', type=int, default=50, help='number of synthetic reports')
+    parser.add_argument(
+        '--num-pages', type=int, default=20, help='number of pages of each report')
+    parser.add_argument(
+        '--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument(
+        '--no-tabula', action='store_true', help="don't benchmark the tabula extractor")
+    parser.add_argument(
+        '--output', type=Path, default=None, help='JSON file the results are written to')
+    parser.add_argument(
+        '--compare', type=Path, default=None, help='JSON file with results to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.num_reports, args.num_pages,
+                            memory=not args.no_memory, with_tabula=not args.no_tabula)
+    print()
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_results(results, baseline)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+        print('\nResults written to', args.output)
+
+    heavy_modules = results['stages']['import update_data']['heavy_modules']
+    if heavy_modules:
+        print('\nERROR: update_data imports heavy modules at startup:', ', '.join(heavy_modules))
+        sys.exit(1)
@@ -0,0 +1,85 @@
+"""
+Write/read the full dataset in Feather format (Arrow IPC), i.e. a typed binary
+columnar format that can be memory-mapped, so that it can be loaded much faster
+than the CSV version. The Feather file is a local copy (in the cache folder),
+it's not published in the dataset repository.
+"""
+from pathlib import Path
+from typing import (
+    Collection,
+    Dict,
+    Iterator
+)
+
+import pandas as pd
+import pyarrow
+from pyarrow import feather, ipc
+
+from settings import FULL_DATASET_FEATHER_PATH
+from table_extraction.common import (
+    COLUMN_PREFIXES,
+    cartesian_join
+)
+
+INDEX_NAMES = ['date', 'age_group']
+INT_COLUMNS = list(cartesian_join(COLUMN_PREFIXES, ['cases', 'deaths']))
+
+
+def typed_dtypes(columns, nan_columns: Collection[str]) -> Dict[str, str]:
+    """ int64 for count columns (if they don't contain NaNs), float64 for all others """
+    return {col: ('int64' if col in INT_COLUMNS and col not in nan_columns else 'float64')
+            for col in columns}
+
+
+class FeatherWriter:
+    """
+    Writes the full dataset to a Feather file one chunk (e.g. one date) at a
+    time, so that it's never entirely in memory. Since the types of the columns
+    must be known in advance, the columns containing NaNs must be passed.
+    """
+
+    def __init__(self, path: Path, columns, nan_columns: Collection[str]):
+        self.path = path
+        self.dtypes = typed_dtypes(columns, nan_columns)
+        self._writer = None
+
+    def write(self, chunk: pd.DataFrame):
+        table = pyarrow.Table.from_pandas(chunk.astype(self.dtypes), preserve_index=True)
+        if self._writer is None:
+            # Uncompressed, so that the file can be memory-mapped
+            self._writer = ipc.new_file(str(self.path), table.schema,
+                                        options=ipc.IpcWriteOptions(compression=None))
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_full_dataset_chunks(path: Path) -> Iterator[pd.DataFrame]:
+    """ Yields the record batches of a full dataset Feather file as DataFrames """
+    with pyarrow.memory_map(str(path)) as source:
+        reader = ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield pyarrow.Table.from_batches([batch], schema=reader.schema).to_pandas()
+
+
+def load_full_dataset(path=FULL_DATASET_FEATHER_PATH, columns=None) -> pd.DataFrame:
+    """
+    Loads the full dataset from its Feather version (memory-mapped), returning
+    a DataFrame indexed by (date, age_group).
+    """
+    if columns is not None:
+        columns = [*INDEX_NAMES, *columns]
+    table = feather.read_table(str(path), columns=columns, memory_map=True)
+    full = table.to_pandas()
+    if list(full.index.names) != INDEX_NAMES:  # index columns were not selected explicitly
+        full = full.set_index(INDEX_NAMES)
+    return full
@@ -0,0 +1,216 @@
+"""
+Queries on the full dataset (CSV) that don't need to load the entire file.
+
+A persistent index stores the byte offset of each row of the full dataset, the
+range of rows of each date and the positions of the rows of each age group.
+Queries read only the rows they need from the memory-mapped file. Since rows of
+new dates are appended to the full dataset (see make_full_dataset), the index is
+extended reading only the new rows; it's rebuilt if the file changed otherwise.
+
+Example::
+
+    query = DatasetQuery()
+    query.get_series('20-29', ['cases', 'deaths'], start='2020-04-01')
+    query.get_snapshot('2020-05-01')
+"""
+import bisect
+import hashlib
+import io
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence
+)
+
+import pandas as pd
+
+from file_index import load_json_or_empty, write_text_atomically
+from settings import FULL_DATASET_QUERY_INDEX_PATH, get_full_dataset_path
+
+
+def _line_digest(line: bytes) -> str:
+    return hashlib.sha1(line).hexdigest()
+
+
+def _scan_rows(data, start: int, index: Dict[str, Any]):
+    """ Adds to the index the rows of data[start:] (data must end with a newline) """
+    offsets = index['offsets']
+    date_rows = index['dates']
+    age_group_rows = index['age_groups']
+    row = len(offsets) - 1
+    pos = start
+    size = len(data)
+    while pos < size:
+        end = data.find(b'\n', pos) + 1 or size
+        date, age_group, _ = data[pos:end].split(b',', 2)
+        date, age_group = date.decode('utf-8'), age_group.decode('utf-8')
+        if date in date_rows:
+            date_rows[date][1] = row + 1
+        else:
+            date_rows[date] = [row, row + 1]
+        age_group_rows.setdefault(age_group, []).append(row)
+        offsets.append(end)
+        row += 1
+        pos = end
+
+
+def build_index(data) -> Dict[str, Any]:
+    """
+    Returns the index of the full dataset given its content (bytes or mmap):
+     - offsets: offsets[i] and offsets[i + 1] delimit row i (offsets[0] is the
+       end of the header)
+     - dates: date -> [first row, last row + 1]
+     - age_groups: age group -> list of rows
+    """
+    header_end = data.find(b'\n') + 1
+    index = {
+        'header': data[:header_end].decode('utf-8'),
+        'offsets': [header_end],
+        'dates': {},
+        'age_groups': {},
+    }
+    _scan_rows(data, header_end, index)
+    return index
+
+
+class DatasetQuery:
+    """
+    Answers queries on the full dataset (CSV) reading only the needed rows.
+    The index is checked (and updated if needed) before each query, so that an
+    instance can be kept alive while the dataset is updated.
+    """
+
+    def __init__(self, path=None, index_path=FULL_DATASET_QUERY_INDEX_PATH):
+        self.path = Path(path or get_full_dataset_path())
+        self.index_path = Path(index_path)
+        self._index: Optional[Dict[str, Any]] = None
+        self._map: Optional[mmap.mmap] = None
+        self._stat = None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load_saved_index(self) -> Optional[Dict[str, Any]]:
+        index = load_json_or_empty(self.index_path)
+        return index if index.get('path') == str(self.path.resolve()) else None
+
+    def _is_prefix(self, index: Dict[str, Any], data) -> bool:
+        """ True if the file indexed by index is a prefix of data """
+        offsets = index['offsets']
+        if len(data) < offsets[-1] or data[:offsets[0]].decode('utf-8') != index['header']:
+            return False
+        last_line = data[offsets[-2]:offsets[-1]] if len(offsets) > 1 else b''
+        return _line_digest(last_line) == index['last_line_digest']
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        stat = (stat.st_size, stat.st_mtime_ns)
+        if stat == self._stat:
+            return
+        self.close()
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index = self._index or self._load_saved_index()
+        if index is not None and [index['size'], index['mtime_ns']] == list(stat):
+            self._index, self._stat = index, stat
+            return
+
+        if index is not None and self._is_prefix(index, self._map):
+            _scan_rows(self._map, index['offsets'][-1], index)
+        else:
+            index = build_index(self._map)
+        offsets = index['offsets']
+        last_line = self._map[offsets[-2]:offsets[-1]] if len(offsets) > 1 else b''
+        index.update(path=str(self.path.resolve()), size=stat[0], mtime_ns=stat[1],
+                     last_line_digest=_line_digest(last_line))
+        write_text_atomically(self.index_path, json.dumps(index))
+        self._index, self._stat = index, stat
+
+    @property
+    def index(self) -> Dict[str, Any]:
+        self._refresh()
+        return self._index
+
+    def dates(self) -> List[str]:
+        return sorted(self.index['dates'])
+
+    def age_groups(self) -> List[str]:
+        return list(self.index['age_groups'])
+
+    def _read_rows(self, rows: Sequence[int], columns=None, index_col='date') -> pd.DataFrame:
+        offsets = self._index['offsets']
+        data = self._map
+        lines = b''.join(data[offsets[row]:offsets[row + 1]] for row in rows)
+        usecols = None if columns is None else ['date', 'age_group', *columns]
+        buffer = io.BytesIO(self._index['header'].encode('utf-8') + lines)
+        table = pd.read_csv(buffer, usecols=usecols, index_col=index_col)
+        if columns is not None:
+            table = table[list(columns)]
+        return table
+
+    def get_series(self, age_group: str, columns: Optional[Sequence[str]] = None,
+                   start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Returns the rows of an age group with date between start and end
+        (included), indexed by date. If columns is None, all columns are returned
+        (including age_group).
+        """
+        index = self.index
+        if age_group not in index['age_groups']:
+            raise KeyError(age_group)
+        rows = index['age_groups'][age_group]
+        date_rows = index['dates']
+        dates = sorted(date_rows)
+        if start is not None:
+            i = bisect.bisect_left(dates, start)
+            first_row = date_rows[dates[i]][0] if i < len(dates) else len(index['offsets'])
+            rows = rows[bisect.bisect_left(rows, first_row):]
+        if end is not None:
+            i = bisect.bisect_right(dates, end)
+            end_row = date_rows[dates[i - 1]][1] if i > 0 else 0
+            rows = rows[:bisect.bisect_left(rows, end_row)]
+        return self._read_rows(rows, columns)
+
+    def get_snapshot(self, date: str) -> pd.DataFrame:
+        """ Returns the rows of a date indexed by age group (like a single-date dataset) """
+        index = self.index
+        if date not in index['dates']:
+            raise KeyError(date)
+        first, end = index['dates'][date]
+        table = self._read_rows(range(first, end), index_col='age_group')
+        return table.drop(columns='date')
+
+
+_default_query: Optional[DatasetQuery] = None
+
+
+def _get_default_query() -> DatasetQuery:
+    global _default_query
+    if _default_query is None:
+        _default_query = DatasetQuery()
+    return _default_query
+
+
+def get_series(age_group: str, columns: Optional[Sequence[str]] = None,
+               start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+    """ Like DatasetQuery.get_series() on the default full dataset """
+    return _get_default_query().get_series(age_group, columns, start, end)
+
+
+def get_snapshot(date: str) -> pd.DataFrame:
+    """ Like DatasetQuery.get_snapshot() on the default full dataset """
+    return _get_default_query().get_snapshot(date)
@@ -0,0 +1,89 @@
+"""
+Daily deltas and rolling averages computed from the (cumulative) counts of the
+full dataset. Since reports are not published every day, each row reports the
+number of days since the previous report and per-day values.
+
+The computation for new dates needs only a few previous rows (the "context"),
+so the deltas dataset can be updated incrementally (see make_deltas_dataset in
+make_datasets.py).
+"""
+from typing import Optional
+
+import pandas as pd
+
+COUNT_COLUMNS = ['cases', 'deaths']
+WINDOW_DAYS = 7
+DELTA_COLUMNS = [
+    'days',
+    *(col
+      for count_col in COUNT_COLUMNS
+      for col in [f'new_{count_col}',
+                  f'new_{count_col}_per_day',
+                  f'new_{count_col}_{WINDOW_DAYS}d_avg',
+                  f'{count_col}_growth_rate'])
+]
+
+
+def compute_deltas(cumulative: pd.DataFrame,
+                   context: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Returns a DataFrame indexed by (date, age_group) with DELTA_COLUMNS for the
+    rows of cumulative (indexed by (date, age_group) and sorted by date):
+
+    - days: days since the previous report;
+    - new_<count>: difference with the previous report;
+    - new_<count>_per_day: new_<count> / days;
+    - new_<count>_7d_avg: average per-day increase in the last 7 days, or rather
+      since the last report published at least 7 days before;
+    - <count>_growth_rate: new_<count> divided by the count of the previous report.
+
+    context contains the rows of the dates preceding the first date of cumulative
+    (see deltas_context()); the first rows of the dataset have no previous report,
+    so they have no deltas.
+    """
+    data = cumulative[COUNT_COLUMNS]
+    if context is not None:
+        data = pd.concat([context[COUNT_COLUMNS], data])
+    data = data.reset_index()
+    data['date'] = pd.to_datetime(data['date'])
+
+    previous = data.groupby('age_group', sort=False)[['date', *COUNT_COLUMNS]].shift()
+
+    window_start = (data[['date', 'age_group']]
+                    .assign(window_start=data['date'] - pd.Timedelta(days=WINDOW_DAYS))
+                    .reset_index()
+                    .sort_values('window_start'))
+    reports = (data[['date', 'age_group', *COUNT_COLUMNS]]
+               .rename(columns={'date': 'window_start'})
+               .assign(start_date=lambda df: df['window_start'])
+               .sort_values('window_start'))
+    start = (pd.merge_asof(window_start, reports, on='window_start', by='age_group',
+                           direction='backward')
+             .set_index('index')
+             .sort_index())
+    window_days = (data['date'] - start['start_date']).dt.days
+
+    deltas = data[['date', 'age_group']].copy()
+    deltas['days'] = (data['date'] - previous['date']).dt.days
+    for col in COUNT_COLUMNS:
+        new = data[col] - previous[col]
+        deltas[f'new_{col}'] = new
+        deltas[f'new_{col}_per_day'] = new / deltas['days']
+        deltas[f'new_{col}_{WINDOW_DAYS}d_avg'] = (data[col] - start[col]) / window_days
+        deltas[f'{col}_growth_rate'] = (new / previous[col].where(previous[col] > 0))
+
+    deltas = deltas.iloc[len(data) - len(cumulative):]
+    deltas['date'] = deltas['date'].dt.strftime('%Y-%m-%d')
+    return deltas.set_index(['date', 'age_group'])[DELTA_COLUMNS]
+
+
+def deltas_context(cumulative: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the rows of cumulative needed for computing the deltas of the dates
+    following the last one, i.e. the rows of the dates from the last report
+    published at least WINDOW_DAYS days before the last date.
+    """
+    dates = pd.to_datetime(cumulative.index.unique(level='date'))
+    old_dates = dates[dates <= dates.max() - pd.Timedelta(days=WINDOW_DAYS)]
+    first_date = (old_dates.max() if len(old_dates) else dates.min()).strftime('%Y-%m-%d')
+    return cumulative[cumulative.index.get_level_values('date') >= first_date][COUNT_COLUMNS]
@@ -2,9 +2,24 @@
 Parse the ISS news page to obtain all links to reports published until now,
 then download all reports missing in the ISS_REPORT folder.
 """
+import hashlib
+import json
+import os
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
 from pprint import pprint
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple
+)
 from urllib.parse import unquote, urljoin
 
 import requests
@@ -12,7 +27,13 @@ from reagex import reagex
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
-from settings import ISS_REPORTS_DIR, ISS_REPORT_MIN_DATE, get_report_path
+from file_index import load_json_or_empty, write_text_atomically
+from settings import (
+    ISS_NEWS_PAGE_STATE_PATH,
+    ISS_REPORTS_DIR,
+    ISS_REPORT_MIN_DATE,
+    get_report_path
+)
 
 # Page from which reports URL are extracted
 ISS_NEWS_URL = 'https://www.epicentro.iss.it/coronavirus/aggiornamenti'
@@ -59,11 +80,51 @@ def _report_date_extractor():
 get_date_from_report_filename = _report_date_extractor()
 
 
+def _parse_report_urls(html):
+    relative_urls = re.findall('href="(bollettino/Bollettino.+[.]pdf)"', html)
+    return [urljoin(ISS_NEWS_URL, relurl) for relurl in relative_urls]
+
+
 def extract_report_urls_from(page_url=ISS_NEWS_URL, session=None):
     resp = session.get(page_url) if session else requests.get(page_url)
     resp.raise_for_status()
-    relative_urls = re.findall('href="(bollettino/Bollettino.+[.]pdf)"', resp.text)
-    return [urljoin(ISS_NEWS_URL, relurl) for relurl in relative_urls]
+    return _parse_report_urls(resp.text)
+
+
+def extract_report_urls_if_changed(page_url=ISS_NEWS_URL, session=None,
+                                   page_state: Optional[Dict] = None,
+                                   ) -> Tuple[Optional[List[str]], Dict]:
+    """
+    Like extract_report_urls_from() but the page is requested with a conditional
+    GET using the ETag and Last-Modified returned by the previous request, stored
+    in page_state; moreover, the page is not parsed if its content is identical
+    to the previous one.
+
+    Returns a tuple (urls, new_page_state) where urls is None if the page didn't
+    change since the request page_state refers to.
+    """
+    session = session or requests
+    if page_state and page_state.get('url') != page_url:
+        page_state = None
+    headers = {}
+    if page_state:
+        if page_state.get('etag'):
+            headers['If-None-Match'] = page_state['etag']
+        if page_state.get('last_modified'):
+            headers['If-Modified-Since'] = page_state['last_modified']
+    resp = session.get(page_url, headers=headers)
+    if resp.status_code == 304:
+        return None, page_state
+    resp.raise_for_status()
+    new_page_state = {
+        'url': page_url,
+        'etag': resp.headers.get('ETag'),
+        'last_modified': resp.headers.get('Last-Modified'),
+        'digest': hashlib.sha1(resp.content).hexdigest(),
+    }
+    if page_state and page_state.get('digest') == new_page_state['digest']:
+        return None, new_page_state
+    return _parse_report_urls(resp.text), new_page_state
 
 
 def get_http_session(
@@ -71,8 +132,13 @@ def get_http_session(
     backoff_factor=0.3,
     status_forcelist=(500, 502, 504),
     session=None,
+    pool_maxsize=10,
 ):
-    """ Taken from: https://www.peterbe.com/plog/best-practice-with-retries-with-requests """
+    """
+    Taken from: https://www.peterbe.com/plog/best-practice-with-retries-with-requests
+    pool_maxsize is the max number of connections kept alive per host; it should be
+    at least the number of threads sharing the session.
+    """
     session = session or requests.Session()
     retry = Retry(
         total=retries,
@@ -81,48 +147,162 @@ def get_http_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
-def download_file(url: str, path: Path, session=None):
-    resp = session.get(url) if session else requests.get(url)
-    resp.raise_for_status()
-    path.write_bytes(resp.content)
+def download_file(url: str, path: Path, session=None, chunk_size=1 << 16) -> int:
+    """
+    Streams the file to "{path}.part", which is renamed to path when complete.
+    If the ".part" file already exists (i.e. a previous download was interrupted),
+    the download is resumed by an HTTP Range request; if the server doesn't
+    support ranges, the file is downloaded from scratch.
+
+    Returns the number of bytes downloaded.
+    """
+    session = session or requests
+    part_path = path.with_name(path.name + '.part')
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    with session.get(url, headers=headers, stream=True) as resp:
+        if resp.status_code == 416:  # Range Not Satisfiable: the partial file is unusable
+            part_path.unlink()
+            return download_file(url, path, session, chunk_size)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            offset = 0
+        # Content-Length can't be compared with the decoded content length if encoded
+        content_length = (resp.headers.get('Content-Length')
+                          if 'Content-Encoding' not in resp.headers else None)
+        # Keep what was received if the connection drops: the length is checked below
+        resp.raw.enforce_content_length = False
+        num_bytes = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in resp.iter_content(chunk_size):
+                f.write(chunk)
+                num_bytes += len(chunk)
+    if content_length is not None and num_bytes != int(content_length):
+        raise IOError('incomplete download of %s: got %d of %s bytes (the download will be '
+                      'resumed next time)' % (url, num_bytes, content_length))
+    os.replace(part_path, path)
+    return num_bytes
 
 
 def download_missing_reports(urls_by_date=EXTRA_REPORT_URLS,
                              scrape_url=ISS_NEWS_URL,
                              output_dir=ISS_REPORTS_DIR,
-                             min_date=ISS_REPORT_MIN_DATE):
+                             min_date=ISS_REPORT_MIN_DATE,
+                             workers=4,
+                             state_path=ISS_NEWS_PAGE_STATE_PATH,
+                             metrics=None,
+                             session=None,
+                             on_download: Optional[Callable[[Path], None]] = None):
+    """
+    Downloads missing reports using up to `workers` concurrent connections.
+    If on_download is provided, it's called with the path of each report as soon
+    as it's downloaded.
+
+    If state_path is not None, the state of the scraped page (see
+    extract_report_urls_if_changed) and the report URLs found in it are stored
+    there after all reports are downloaded; when the page doesn't change, the
+    stored URLs are used (and kept in the state even if the page validators
+    changed), so that nothing is parsed or downloaded (unless some report file
+    is missing).
+
+    If metrics (a metrics.Metrics) is provided, the scraping is timed as the
+    stage "download.scrape" (nested in the download stage of the caller) and the
+    number of downloaded reports and bytes are counted.
+
+    A session (see get_http_session) can be passed to reuse its connections
+    across calls.
+    """
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    session = get_http_session()
-    fetched_urls = extract_report_urls_from(scrape_url, session) if scrape_url else []
+    session = session or get_http_session(pool_maxsize=max(workers, 1))
+    state = load_json_or_empty(state_path) if state_path else {}
+    if scrape_url:
+        with (metrics.stage('download.scrape') if metrics else nullcontext()):
+            fetched_urls, page_state = extract_report_urls_if_changed(
+                scrape_url, session, state.get('page'))
+        page_changed = fetched_urls is not None
+        if not page_changed:
+            print('The ISS news page did not change since the last check')
+            fetched_urls = state.get('report_urls', [])
+    else:
+        fetched_urls, page_changed = [], False
     date2url = {
         get_date_from_report_filename(url): url
         for url in fetched_urls
     }
     date2url.update(urls_by_date)
-    print('Report URLs by date:')
-    pprint(date2url, indent=2)
-    print('')
+    if page_changed:
+        print('Report URLs by date:')
+        pprint(date2url, indent=2)
+        print('')
 
-    new_report_paths = []
+    missing = []
     for date, url in date2url.items():
         if date < min_date:
             continue
         path = get_report_path(date=date, dirpath=output_dir)
         if not path.exists():
             print('Found new report (%s): %s' % (date, url))
-            print('Downloading to', path, '...', end=' ')
-            download_file(url, path, session)
+            missing.append((url, path))
+
+    new_report_paths = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        path_by_future = {executor.submit(download_file, url, path, session): path
+                          for url, path in missing}
+        for future in as_completed(path_by_future):
+            num_bytes = future.result()
+            path = path_by_future[future]
             new_report_paths.append(path)
-            print('DONE')
+            print('Downloaded %s (%d bytes)' % (path, num_bytes))
+            if metrics:
+                metrics.count('reports_downloaded')
+                metrics.count('bytes_downloaded', num_bytes)
+            if on_download:
+                on_download(path)
+    # Also when only the validators changed (the page is the same), otherwise the
+    # stale ETag would make each of the next requests download the whole page
+    if state_path and scrape_url and page_state != state.get('page'):
+        write_text_atomically(state_path, json.dumps(
+            {'page': page_state, 'report_urls': fetched_urls}, indent=1))
     if not new_report_paths:
         print('No new reports found')
-    return new_report_paths
+    return sorted(new_report_paths)
+
+
+_END = object()
+
+
+def iter_downloaded_reports(queue_size=8, **kwargs) -> Iterator[Path]:
+    """
+    Starts download_missing_reports(**kwargs) in a background thread and returns
+    an iterator yielding the path of each new report as soon as it's downloaded.
+    At most queue_size downloaded reports wait to be consumed. An exception
+    raised while downloading is re-raised after the reports downloaded before
+    it are yielded.
+    """
+    downloaded: queue.Queue = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def download():
+        try:
+            download_missing_reports(on_download=downloaded.put, **kwargs)
+        except BaseException as exc:
+            errors.append(exc)
+        finally:
+            downloaded.put(_END)
+
+    def iter_paths():
+        yield from iter(downloaded.get, _END)
+        if errors:
+            raise errors[0]
+
+    threading.Thread(target=download, name='download-reports', daemon=True).start()
+    return iter_paths()
 
 
 if __name__ == '__main__':
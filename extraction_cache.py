@@ -0,0 +1,61 @@
+"""
+Cache of the tables extracted from reports. A table is stored by a key that
+depends on the content of the report and on the extractor (class, version and
+configuration), so a table is extracted again only if the report or the
+extractor changed.
+"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from file_index import FileIndex, atomic_output
+from settings import EXTRACTION_CACHE_DIR, FILE_DIGEST_INDEX_PATH
+from table_extraction.common import TableExtractor
+
+
+def extractor_id(table_extractor: TableExtractor) -> str:
+    cls = type(table_extractor)
+    return f'{cls.__module__}.{cls.__qualname__}:{cls.version}'
+
+
+class ExtractionCache:
+
+    def __init__(self, dirpath=EXTRACTION_CACHE_DIR, digest_index: Optional[FileIndex] = None):
+        self.dirpath = Path(dirpath)
+        self.digest_index = digest_index or FileIndex(FILE_DIGEST_INDEX_PATH)
+
+    def key(self, table_extractor: TableExtractor, report_path) -> str:
+        key_data = json.dumps([
+            self.digest_index.digest(report_path),
+            extractor_id(table_extractor),
+            table_extractor.config(),
+        ], sort_keys=True)
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return Path(self.dirpath, key[:2], key + '.pkl')
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the cached table or None; an entry that can't be read (e.g. it's
+        truncated or was written by an incompatible version of pandas) is
+        deleted and treated as missing.
+        """
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            return pd.read_pickle(str(path))
+        except Exception:
+            logging.warning('Removing unreadable entry of the extraction cache: %s', path,
+                            exc_info=True)
+            path.unlink(missing_ok=True)
+            return None
+
+    def put(self, key: str, table: pd.DataFrame):
+        with atomic_output(self._path(key)) as tmp_path:
+            table.to_pickle(str(tmp_path))
@@ -0,0 +1,135 @@
+"""
+Persistent (JSON) index associating data to files.
+
+An entry is valid as long as the content of its file doesn't change. To detect
+changes cheaply, the size and the modification time of the file are checked
+first; the file is hashed only if its size is unchanged but its mtime isn't
+(e.g. the file was touched or copied).
+"""
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    Optional
+)
+
+
+def file_digest(path, algorithm='sha1', chunk_size=1 << 20) -> str:
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_output(path) -> Iterator[Path]:
+    """
+    Yields a temporary path in the same folder of path (created if missing), which
+    is renamed to path at the end of the block or deleted if an exception is raised
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    os.close(fd)
+    try:
+        yield Path(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def write_text_atomically(path: Path, text: str):
+    """ Writes to a temporary file in the same folder, then renames it to path """
+    with atomic_output(path) as tmp_path:
+        tmp_path.write_text(text, encoding='utf-8')
+
+
+def load_json_or_empty(path) -> Dict[str, Any]:
+    """ Returns the content of a JSON file or {} if the file is missing or invalid """
+    try:
+        return json.loads(Path(path).read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+class FileIndex:
+    """
+    A persistent mapping from files to dictionaries of JSON-serializable data.
+
+    Changes are saved immediately. Since the file is re-read and merged before
+    saving, the same index can be updated by multiple processes (an update can
+    be lost in a race, which is fine for a cache).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._entries = None
+
+    @staticmethod
+    def _key(file_path) -> str:
+        return str(Path(file_path).resolve())
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        return load_json_or_empty(self.path)
+
+    @property
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _save(self, key):
+        entries = self._read()
+        entries[key] = self.entries[key]
+        write_text_atomically(self.path, json.dumps(entries, indent=1, sort_keys=True))
+
+    def _valid_entry(self, file_path) -> Optional[Dict[str, Any]]:
+        key = self._key(file_path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stat = os.stat(file_path)
+        if stat.st_size != entry['size']:
+            return None
+        if stat.st_mtime_ns != entry['mtime_ns']:
+            if file_digest(file_path) != entry['digest']:
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+            self._save(key)
+        return entry
+
+    def lookup(self, file_path) -> Optional[Dict[str, Any]]:
+        """ Returns the data associated to the file if it didn't change, otherwise None """
+        entry = self._valid_entry(file_path)
+        return None if entry is None else entry['data']
+
+    def digest(self, file_path) -> str:
+        """ Returns the file digest, computing it only if the file changed """
+        entry = self._valid_entry(file_path)
+        if entry is None:
+            entry = self.update(file_path)
+        return entry['digest']
+
+    def update(self, file_path, digest: Optional[str] = None, **data) -> Dict[str, Any]:
+        """ Associates data to the current content of the file (merging with old data) """
+        key = self._key(file_path)
+        stat = os.stat(file_path)
+        digest = digest or file_digest(file_path)
+        old_entry = self.entries.get(key)
+        old_data = old_entry['data'] if old_entry and old_entry['digest'] == digest else {}
+        self.entries[key] = entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': digest,
+            'data': {**old_data, **data},
+        }
+        self._save(key)
+        return entry
@@ -0,0 +1,34 @@
+"""
+Measures the import time of a module in a new interpreter (see benchmark.py
+and tests/test_imports.py). This module imports only light modules, so that
+it can be used without loading pandas and PyPDF3 like benchmark.py does.
+"""
+import json
+import subprocess
+import sys
+from typing import Dict
+
+from settings import PROJECT_DIR
+
+# Modules that update_data.py must not import at startup (see measure_import)
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'PyPDF3', 'tabula', 'git', 'pynotifier')
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'heavy_modules': [m for m in {heavy_modules!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module='update_data') -> Dict:
+    """
+    Measures the import time of a module in a new interpreter and returns it
+    together with the HEAVY_MODULES it imported
+    """
+    script = _IMPORT_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=PROJECT_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
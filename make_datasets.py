@@ -1,19 +1,57 @@
 """
 Download new reports and make all datasets, skipping existing ones.
 """
+import hashlib
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import chain, groupby
 from pathlib import Path
 from typing import (
+    Dict,
+    Iterable,
+    Iterator,
     List,
-    Tuple
+    Optional,
+    Set,
+    Tuple,
+    Union
 )
 
 import pandas as pd
 
+from columnar import (
+    INDEX_NAMES,
+    FeatherWriter,
+    iter_full_dataset_chunks
+)
+from deltas import compute_deltas, deltas_context
+from extraction_cache import ExtractionCache
+from file_index import FileIndex, atomic_output, load_json_or_empty, write_text_atomically
+from metrics import Metrics
 from settings import (
+    DELTAS_DATASET_PARTITIONS_DIR,
+    DELTAS_DATASET_PARTITIONS_STATE_PATH,
+    DELTAS_DATASET_STATE_PATH,
+    FILE_DIGEST_INDEX_PATH,
     FULL_DATASET_DIR,
+    FULL_DATASET_FEATHER_PATH,
+    FULL_DATASET_MANIFEST_PATH,
+    FULL_DATASET_PARTITIONS_DIR,
+    FULL_DATASET_PARTITIONS_STATE_PATH,
     ISS_REPORTS_DIR,
+    PARTITIONS_MANIFEST_FNAME,
     DATA_BY_DATE_DIR,
+    TABLE_PAGE_INDEX_PATH,
+    TABULA_TEMPLATES_DIR,
+    TABULA_TEMPLATE_PLANS_PATH,
     get_date_from_filename,
+    get_deltas_dataset_partition_path,
+    get_deltas_dataset_path,
+    get_full_dataset_partition_path,
     get_full_dataset_path,
     get_single_date_dataset_path
 )
@@ -22,64 +60,770 @@ from table_extraction.common import (
     recompute_derived_columns
 )
 from table_extraction.pypdf_extractor import PyPDFTableExtractor
+from table_extraction.stream_extractor import ContentStreamTableExtractor
+
+EXTRACTION_ENGINES = ('pypdf', 'stream', 'tabula', 'tabula-batch')
+
+
+def get_table_extractor(engine: str = 'pypdf',
+                        page_index_path: Optional[Path] = TABLE_PAGE_INDEX_PATH) -> TableExtractor:
+    """ Returns the table extractor for one of EXTRACTION_ENGINES """
+    page_index = FileIndex(page_index_path) if page_index_path else None
+    if engine == 'pypdf':
+        return PyPDFTableExtractor(page_index)
+    if engine == 'stream':
+        return ContentStreamTableExtractor(page_index)
+    if engine in ('tabula', 'tabula-batch'):
+        from table_extraction.tabula_extractor import TabulaTableExtractor  # requires Java
+        return TabulaTableExtractor(TABULA_TEMPLATES_DIR, page_index,
+                                    batched=(engine == 'tabula-batch'),
+                                    plans_path=TABULA_TEMPLATE_PLANS_PATH)
+    raise ValueError('unknown extraction engine: %r. Valid values: %s'
+                     % (engine, ', '.join(EXTRACTION_ENGINES)))
+
+
+class DatasetCreationError(Exception):
+    """
+    Raised when the dataset of one or more reports couldn't be made or when the
+    processing of the reports was interrupted by an error (stopped_by), e.g. a
+    download error in pipelined mode
+    """
+    def __init__(self, errors: Dict[str, Exception], new_dataset_paths: List[Path],
+                 stopped_by: Optional[BaseException] = None):
+        self.errors = errors  # by report date
+        self.new_dataset_paths = new_dataset_paths
+        self.stopped_by = stopped_by
+        lines = [f'- {date}: {exc!r}' for date, exc in errors.items()]
+        if stopped_by is not None:
+            lines.append(f'processing of the reports stopped by: {stopped_by!r}')
+        super().__init__('unable to make the dataset for the report(s) of: %s\n%s' % (
+            ', '.join(errors) or '-', '\n'.join(lines)))
+
+
+def _write_single_date_dataset(table: pd.DataFrame, out_path: Path, stats: Dict) -> Dict:
+    """ Writes the dataset unless an identical one already exists """
+    table = recompute_derived_columns(table)
+    # Compared as bytes: to_csv() ends lines with os.linesep, which a text read would translate
+    content = table.to_csv(index=False).encode('utf-8')
+    stats['rows'] = len(table)
+    stats['changed'] = not out_path.exists() or out_path.read_bytes() != content
+    if stats['changed']:
+        out_path.write_bytes(content)
+    return stats
+
+
+def _extract_single_date_table(table_extractor: TableExtractor, path: Path, date: str,
+                              cache: Optional[ExtractionCache] = None,
+                              cache_key: Optional[str] = None) -> Tuple[pd.DataFrame, Dict]:
+    """ Returns the table of the report (from the cache if possible) and some stats """
+    start = time.perf_counter()
+    stats = {'date': date}
+    table = cache.get(cache_key) if cache else None
+    if table is not None:
+        stats['cached'] = True
+    else:
+        table = table_extractor(path, date, stats)
+        if cache:
+            cache.put(cache_key, table)
+    stats['seconds'] = round(time.perf_counter() - start, 4)
+    return table, stats
+
+
+def _make_single_date_dataset(table_extractor: TableExtractor, path: Path,
+                              date: str, out_path: Path,
+                              cache: Optional[ExtractionCache] = None,
+                              cache_key: Optional[str] = None) -> Dict:
+    """ Makes the dataset and returns some stats about it """
+    start = time.perf_counter()
+    table, stats = _extract_single_date_table(table_extractor, path, date, cache, cache_key)
+    _write_single_date_dataset(table, out_path, stats)
+    stats['seconds'] = round(time.perf_counter() - start, 4)
+    return stats
+
+
+def _iter_batch_outcomes(jobs):
+    """
+    Like _iter_outcomes(_make_single_date_dataset, jobs) but the tables that are
+    not cached are extracted at once with table_extractor.extract_many()
+    """
+    tables = [cache.get(cache_key) if cache else None
+              for _, _, _, _, cache, cache_key in jobs]
+    to_extract = [i for i, table in enumerate(tables) if table is None]
+    outcome_by_job = {}
+    if to_extract:
+        table_extractor = jobs[0][0]
+        start = time.perf_counter()
+        outcomes = table_extractor.extract_many([jobs[i][1:3] for i in to_extract])
+        seconds_per_report = round((time.perf_counter() - start) / len(to_extract), 4)
+        for i, outcome in zip(to_extract, outcomes):
+            outcome.stats['seconds'] = seconds_per_report
+            outcome_by_job[i] = outcome
+
+    for i, (_, _, date, out_path, cache, cache_key) in enumerate(jobs):
+        if i in outcome_by_job:
+            table, extraction_stats, exc = outcome_by_job[i]
+            if exc is not None:
+                yield None, exc
+                continue
+            stats = {'date': date, **extraction_stats}
+            if cache:
+                cache.put(cache_key, table)
+        else:
+            table, stats = tables[i], {'date': date, 'cached': True}
+        try:
+            yield _write_single_date_dataset(table, out_path, stats), None
+        except Exception as exc:
+            yield None, exc
+
+
+def _iter_outcomes(fn, jobs, workers=1):
+    """
+    Calls fn(*job) for each job and yields a tuple (result, exception) in the
+    same order of jobs. If workers > 1, the calls are done in a process pool.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                yield fn(*job), None
+            except Exception as exc:
+                yield None, exc
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            futures = [executor.submit(fn, *job) for job in jobs]
+            for future in futures:
+                exc = future.exception()
+                yield (None if exc else future.result()), exc
 
 
 def make_single_date_datasets(reports_dir: Path = ISS_REPORTS_DIR,
                               data_dir: Path = DATA_BY_DATE_DIR,
-                              table_extractor: TableExtractor = PyPDFTableExtractor(),
-                              skip_existing=True) -> List[Path]:
+                              table_extractor: Union[TableExtractor, str] = 'pypdf',
+                              skip_existing=True,
+                              workers: int = 1,
+                              metrics: Optional[Metrics] = None,
+                              cache: Optional[ExtractionCache] = None,
+                              dates: Optional[Iterable[str]] = None) -> List[Path]:
+    """
+    Makes a dataset for each report in reports_dir (or only for the reports of
+    the given dates) and returns the paths of the datasets that were written,
+    i.e. that didn't exist or changed.
+
+    table_extractor can also be the name of one of EXTRACTION_ENGINES. With
+    workers > 1, reports are processed in parallel by a pool of processes (so,
+    table_extractor must be picklable), unless table_extractor is batched, in
+    which case all tables are extracted at once by table_extractor.extract_many().
+
+    If a cache is provided, tables are extracted only if the report or the
+    extractor changed since they were cached; using a cache, it's cheap to
+    remake all datasets passing skip_existing=False.
+
+    A failure doesn't stop the processing of the other reports: all errors are
+    collected and raised at the end in a DatasetCreationError.
+
+    If metrics is provided, a record with the stats of each report is added.
+    """
+    if isinstance(table_extractor, str):
+        table_extractor = get_table_extractor(table_extractor)
+    dates = set(dates) if dates is not None else None
     data_dir.mkdir(parents=True, exist_ok=True)
-    new_dataset_paths = []
-    relative_paths = sorted(reports_dir.iterdir())
-    for relpath in relative_paths:
-        path = reports_dir / relpath
-        date = relpath.stem
+    jobs = []
+    # Only complete reports: interrupted downloads leave "*.pdf.part" files
+    for path in sorted(reports_dir.glob('*.pdf')):
+        date = path.stem
+        if dates is not None and date not in dates:
+            continue
         out_path = get_single_date_dataset_path(date, dirpath=data_dir)
-        print('-' * 80)
         if skip_existing and out_path.exists():
             print(f'Dataset for report of {date} already exists')
         else:
+            cache_key = cache.key(table_extractor, path) if cache else None
+            jobs.append((table_extractor, path, date, out_path, cache, cache_key))
+
+    if table_extractor.batched:
+        outcomes = _iter_batch_outcomes(jobs)
+    else:
+        outcomes = _iter_outcomes(_make_single_date_dataset, jobs, workers=workers)
+    return _collect_outcomes(
+        ((date, out_path, *outcome)
+         for (_, _, date, out_path, _, _), outcome in zip(jobs, outcomes)),
+        metrics)
+
+
+def _collect_outcomes(outcomes: Iterable[Tuple[str, Path, Optional[Dict], Optional[Exception]]],
+                      metrics: Optional[Metrics] = None) -> List[Path]:
+    """
+    Reports each (date, out_path, stats, exception) outcome and returns the paths
+    of the datasets that were written; raises a DatasetCreationError at the end
+    if any dataset couldn't be made or if outcomes raised an exception (which is
+    chained), so that the datasets written before are known to the caller.
+    """
+    new_dataset_paths = []
+    errors = {}
+    stopped_by = None
+    try:
+        for date, out_path, stats, exc in outcomes:
+            print('-' * 80)
             print(f"Making dataset for report of {date} ...")
-            table = table_extractor(path, date)
-            table = recompute_derived_columns(table)
-            table.to_csv(out_path, index=False)
-            new_dataset_paths.append(out_path)
-            print('Saved to', out_path)
+            if exc is None:
+                if stats['changed']:
+                    new_dataset_paths.append(out_path)
+                    print('Saved to', out_path)
+                    if metrics:
+                        metrics.count('rows_written', stats['rows'])
+                else:
+                    print('Dataset unchanged:', out_path)
+                if metrics:
+                    metrics.record('report', **stats)
+            else:
+                errors[date] = exc
+                print(f'FAILED: {exc!r}')
+                if metrics:
+                    metrics.record('report', date=date, error=repr(exc))
+    except Exception as exc:  # raised by outcomes itself, e.g. a download error
+        stopped_by = exc
+        print(f'FAILED: {exc!r}')
 
     print('\nNew datasets written:', new_dataset_paths, end='\n\n')
+    if errors or stopped_by is not None:
+        raise DatasetCreationError(errors, new_dataset_paths, stopped_by) from stopped_by
     return new_dataset_paths
 
 
+_END = object()
+
+
+def _iter_pipelined_outcomes(report_paths: Iterable[Path], data_dir: Path,
+                             table_extractor: TableExtractor, skip_existing: bool,
+                             executor: Executor, cache: Optional[ExtractionCache],
+                             dates: Optional[Set[str]], queue_size: int):
+    """
+    Yields (date, out_path, stats, exception) for each report, writing each
+    dataset as soon as its table is extracted (see make_single_date_datasets_pipelined)
+    """
+    extractions: queue.Queue = queue.Queue(maxsize=queue_size)
+    feeder_errors = []
+
+    def submit_extractions():
+        seen = set()
+        try:
+            for path in report_paths:
+                date = path.stem
+                if date in seen or (dates is not None and date not in dates):
+                    continue
+                seen.add(date)
+                out_path = get_single_date_dataset_path(date, dirpath=data_dir)
+                if skip_existing and out_path.exists():
+                    print(f'Dataset for report of {date} already exists')
+                    continue
+                cache_key = cache.key(table_extractor, path) if cache else None
+                future = executor.submit(_extract_single_date_table,
+                                         table_extractor, path, date, cache, cache_key)
+                extractions.put((date, out_path, future))
+        except BaseException as exc:
+            feeder_errors.append(exc)
+        finally:
+            extractions.put(_END)
+
+    feeder = threading.Thread(target=submit_extractions, name='submit-extractions', daemon=True)
+    feeder.start()
+    for date, out_path, future in iter(extractions.get, _END):
+        try:
+            table, stats = future.result()
+            yield date, out_path, _write_single_date_dataset(table, out_path, stats), None
+        except Exception as exc:
+            yield date, out_path, None, exc
+    feeder.join()
+    if feeder_errors:
+        raise feeder_errors[0]
+
+
+def make_single_date_datasets_pipelined(report_paths: Iterable[Path],
+                                        data_dir: Path = DATA_BY_DATE_DIR,
+                                        table_extractor: Union[TableExtractor, str] = 'pypdf',
+                                        skip_existing=True,
+                                        workers: int = 1,
+                                        metrics: Optional[Metrics] = None,
+                                        cache: Optional[ExtractionCache] = None,
+                                        dates: Optional[Iterable[str]] = None,
+                                        queue_size: int = 8) -> List[Path]:
+    """
+    Like make_single_date_datasets but the reports are taken from report_paths,
+    which can be a lazy iterable (e.g. download_reports.iter_downloaded_reports()),
+    and each report is processed as soon as it's available: a thread consumes
+    report_paths and submits the extraction of each report to a pool (of
+    processes if workers > 1, otherwise of a single thread), while the calling
+    thread writes the datasets in the order the reports were submitted. At most
+    queue_size extracted (or being extracted) tables wait to be written.
+
+    Batched extractors are called report by report (with extract()).
+
+    Errors of single reports are collected and raised at the end in a
+    DatasetCreationError; an exception raised by report_paths (e.g. a download
+    error) stops the processing and is raised, after the datasets of the reports
+    preceding it are made, as the stopped_by attribute of a DatasetCreationError
+    listing the datasets that were written.
+    """
+    if isinstance(table_extractor, str):
+        table_extractor = get_table_extractor(table_extractor)
+    dates = set(dates) if dates is not None else None
+    data_dir.mkdir(parents=True, exist_ok=True)
+    executor = (ProcessPoolExecutor(max_workers=workers) if workers > 1
+                else ThreadPoolExecutor(max_workers=1))
+    with executor:
+        return _collect_outcomes(
+            _iter_pipelined_outcomes(report_paths, data_dir, table_extractor, skip_existing,
+                                     executor, cache, dates, queue_size),
+            metrics)
+
+
 def list_datasets_by_date(dirpath: Path) -> List[Tuple[str, Path]]:
     date_path = [(get_date_from_filename(path.name), path)
                  for path in dirpath.iterdir()]
     return sorted(date_path, key=lambda p: p[0])
 
 
+def _read_date_dataset(date: str, path: Path) -> pd.DataFrame:
+    table = pd.read_csv(path, index_col='age_group')
+    return pd.concat([table], keys=[date], names=INDEX_NAMES)
+
+
+def _iter_date_datasets(date_path_pairs) -> Iterator[pd.DataFrame]:
+    return (_read_date_dataset(date, path) for date, path in date_path_pairs)
+
+
+def _common_dtypes(dtypes_list: Iterable[Dict[str, str]]) -> Dict[str, str]:
+    """
+    Returns the dtypes of the columns of the concatenation of tables with the
+    given dtypes (like pd.concat does: int64 and float64 give float64).
+    """
+    dtypes_list = list(dtypes_list)
+    columns = list(dtypes_list[0])
+    if any(list(dtypes) != columns for dtypes in dtypes_list):
+        raise ValueError('single-date datasets have different columns')
+    common = {}
+    for col in columns:
+        kinds = {dtypes[col] for dtypes in dtypes_list}
+        if len(kinds) == 1:
+            common[col] = kinds.pop()
+        else:
+            common[col] = 'float64' if kinds <= {'int64', 'float64'} else 'object'
+    return common
+
+
+def _dtypes_of(table: pd.DataFrame) -> Dict[str, str]:
+    return {col: str(dtype) for col, dtype in table.dtypes.items()}
+
+
+def _nan_columns_of(table: pd.DataFrame) -> List[str]:
+    return [col for col in table.columns if table[col].isna().any()]
+
+
+def _scan_date_datasets(date_path_pairs) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Reading one dataset at a time, returns the dtypes of the columns of the full
+    dataset and the columns containing NaNs
+    """
+    dtypes_list = []
+    nan_columns = set()
+    for table in _iter_date_datasets(date_path_pairs):
+        dtypes_list.append(_dtypes_of(table))
+        nan_columns.update(_nan_columns_of(table))
+    return _common_dtypes(dtypes_list), sorted(nan_columns)
+
+
+def _write_feather_chunks(path: Path, chunks: Iterable[pd.DataFrame], columns, nan_columns):
+    with atomic_output(path) as tmp_path, FeatherWriter(tmp_path, columns, nan_columns) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+
+def _file_stat(path: Path) -> Dict:
+    stat = path.stat()
+    return {'path': str(path.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _dates_to_append(manifest: Dict, digests: Dict[str, str],
+                     out_path: Path) -> Optional[List[str]]:
+    """
+    Returns the dates to append to the existing full dataset or None if the full
+    dataset must be rebuilt from scratch, i.e. if the full dataset was modified
+    after the last build or any of the datasets it contains changed.
+    """
+    if not manifest or not out_path.exists():
+        return None
+    if manifest['output'] != _file_stat(out_path):
+        return None
+    return _new_dates(manifest, digests)
+
+
+def _new_dates(manifest: Dict, digests: Dict[str, str]) -> Optional[List[str]]:
+    """
+    Returns the dates added since the manifest was written or None if any of the
+    old datasets changed or the new dates don't follow the old ones
+    """
+    old_digests = manifest['digests']
+    if any(digests.get(date) != digest for date, digest in old_digests.items()):
+        return None
+    new_dates = sorted(set(digests) - set(old_digests))
+    if new_dates and old_digests and new_dates[0] <= max(old_digests):
+        return None  # rows would be out of order
+    return new_dates
+
+
 def make_full_dataset(input_dir=DATA_BY_DATE_DIR,
-                      output_dir=FULL_DATASET_DIR):
+                      output_dir=FULL_DATASET_DIR,
+                      incremental=False,
+                      columnar=True,
+                      manifest_path=FULL_DATASET_MANIFEST_PATH,
+                      digest_index: Optional[FileIndex] = None,
+                      metrics: Optional[Metrics] = None,
+                      feather_path: Path = FULL_DATASET_FEATHER_PATH):
+    """
+    Makes the full dataset concatenating all the single-date datasets. If
+    columnar is True, a Feather version of the dataset is written to feather_path
+    as well (see columnar.py).
+
+    Single-date datasets are read and written one at a time, so that memory usage
+    doesn't grow with the number of dates; the files are written to temporary
+    files, then renamed.
+
+    In incremental mode, the rows of new dates are appended to the existing full
+    dataset; a manifest storing the digest of each single-date dataset is used
+    to check that the other datasets didn't change since the last build, in which
+    case the full dataset is rebuilt from scratch. If there are no new dates,
+    nothing is written.
+    """
     date_path_pairs = list_datasets_by_date(input_dir)
     if not date_path_pairs:
         print('No datasets found in', input_dir)
         return False
 
     out_path = get_full_dataset_path(dirpath=output_dir)
-    iccas_by_date = {}
-    for date, path in date_path_pairs:
-        iccas_by_date[date] = pd.read_csv(path, index_col='age_group')
+    digest_index = digest_index or FileIndex(FILE_DIGEST_INDEX_PATH)
+    digests = {date: digest_index.digest(path) for date, path in date_path_pairs}
+    manifest = load_json_or_empty(manifest_path)
 
-    full = pd.concat(iccas_by_date.values(), axis=0,
-                     keys=iccas_by_date.keys(), names=['date', 'age_group'])
+    dates_to_append = _dates_to_append(manifest, digests, out_path) if incremental else None
+    feather_unchanged = (columnar and feather_path.exists()
+                         and manifest.get('feather') == _file_stat(feather_path))
+    if dates_to_append == [] and (feather_unchanged or not columnar):
+        print('Full dataset is up to date:', out_path)
+        return out_path
+    if dates_to_append is not None:
+        path_by_date = dict(date_path_pairs)
+        new_tables = [_read_date_dataset(date, path_by_date[date]) for date in dates_to_append]
+        old_dtypes = manifest.get('dtypes')
+        dtypes = _common_dtypes([old_dtypes, *map(_dtypes_of, new_tables)]) if old_dtypes else None
+        if dtypes is None or dtypes != old_dtypes:
+            print('The types of some columns changed: the full dataset will be rebuilt')
+            dates_to_append = None
 
     output_dir.mkdir(parents=True, exist_ok=True)
-    full.to_csv(out_path)
+    if columnar:
+        feather_path.parent.mkdir(parents=True, exist_ok=True)
+    if dates_to_append is not None:
+        with open(out_path, 'a', newline='') as f:
+            for table in new_tables:
+                table.astype(dtypes).to_csv(f, header=False)
+        nan_columns = sorted({*manifest['nan_columns'], *chain.from_iterable(
+            map(_nan_columns_of, new_tables))})
+        print('Dates appended to the full dataset:', dates_to_append)
+        if metrics:
+            metrics.count('full_dataset_rows_appended', sum(map(len, new_tables)))
+        if columnar:
+            if feather_unchanged:
+                chunks = chain(iter_full_dataset_chunks(feather_path), new_tables)
+            else:
+                chunks = _iter_date_datasets(date_path_pairs)
+            _write_feather_chunks(feather_path, chunks, list(dtypes), nan_columns)
+    else:
+        dtypes, nan_columns = _scan_date_datasets(date_path_pairs)
+        num_rows = 0
+        with ExitStack() as stack:
+            tmp_path = stack.enter_context(atomic_output(out_path))
+            f = stack.enter_context(open(tmp_path, 'w', newline=''))
+            if columnar:
+                feather_tmp_path = stack.enter_context(atomic_output(feather_path))
+                writer = stack.enter_context(
+                    FeatherWriter(feather_tmp_path, list(dtypes), nan_columns))
+            for i, table in enumerate(_iter_date_datasets(date_path_pairs)):
+                table = table.astype(dtypes)
+                table.to_csv(f, header=(i == 0))
+                if columnar:
+                    writer.write(table)
+                num_rows += len(table)
+        if metrics:
+            metrics.count('full_dataset_rows_written', num_rows)
+
+    manifest = {'output': _file_stat(out_path), 'digests': digests,
+                'dtypes': dtypes, 'nan_columns': nan_columns}
+    if columnar:
+        manifest['feather'] = _file_stat(feather_path)
+        print('Full dataset written to', feather_path)
+
+    write_text_atomically(manifest_path, json.dumps(manifest, indent=1))
     print('Full dataset written to', out_path)
     return out_path
 
 
+def make_partitioned_full_dataset(input_dir=DATA_BY_DATE_DIR,
+                                  output_dir=FULL_DATASET_PARTITIONS_DIR,
+                                  state_path=FULL_DATASET_PARTITIONS_STATE_PATH,
+                                  digest_index: Optional[FileIndex] = None,
+                                  metrics: Optional[Metrics] = None) -> List[Path]:
+    """
+    Writes the full dataset split in monthly partitions (same format of the
+    full dataset) plus a manifest listing, for each month, the partition file,
+    its dates, its number of rows and its SHA-1 digest.
+
+    Only the partitions whose single-date datasets changed are rewritten, so
+    that daily updates touch only the partition of the current month and the
+    manifest. Returns the paths of the files that were written or deleted (i.e.
+    the files to commit).
+    """
+    date_path_pairs = list_datasets_by_date(input_dir)
+    if not date_path_pairs:
+        print('No datasets found in', input_dir)
+        return []
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(output_dir, PARTITIONS_MANIFEST_FNAME)
+    digest_index = digest_index or FileIndex(FILE_DIGEST_INDEX_PATH)
+    old_manifest = load_json_or_empty(manifest_path)
+    old_partitions = old_manifest.get('partitions', {})
+    state = load_json_or_empty(state_path)
+
+    changed_paths = []
+    partitions = {}
+    for month, pairs in groupby(date_path_pairs, key=lambda pair: pair[0][:7]):
+        pairs = list(pairs)
+        out_path = get_full_dataset_partition_path(month, dirpath=output_dir)
+        inputs = [[date, digest_index.digest(path)] for date, path in pairs]
+        inputs_digest = hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+        old = old_partitions.get(month)
+        if (old and state.get(month) == inputs_digest and out_path.exists()
+                and digest_index.digest(out_path) == old['sha1']):
+            partitions[month] = old
+            continue
+
+        partition = pd.concat(list(_iter_date_datasets(pairs)))
+        with atomic_output(out_path) as tmp_path, open(tmp_path, 'w', newline='') as f:
+            partition.to_csv(f)
+        partitions[month] = {
+            'file': out_path.name,
+            'dates': [date for date, _ in pairs],
+            'rows': len(partition),
+            'sha1': digest_index.digest(out_path),
+        }
+        state[month] = inputs_digest
+        changed_paths.append(out_path)
+        print('Full dataset partition written to', out_path)
+        if metrics:
+            metrics.count('full_dataset_partition_rows_written', len(partition))
+
+    for month in set(old_partitions) - set(partitions):
+        path = Path(output_dir, old_partitions[month]['file'])
+        if path.exists():
+            path.unlink()
+            changed_paths.append(path)
+        state.pop(month, None)
+        print('Full dataset partition removed:', path)
+
+    if _write_partitions_manifest(manifest_path, partitions, old_manifest):
+        changed_paths.append(manifest_path)
+    write_text_atomically(state_path, json.dumps(state, indent=1))
+    if not changed_paths:
+        print('Full dataset partitions are up to date')
+    return changed_paths
+
+
+def _write_partitions_manifest(manifest_path: Path, partitions: Dict, old_manifest: Dict) -> bool:
+    """ Writes the manifest of the partitions if it changed; returns True if it was written """
+    manifest = {'partitions': dict(sorted(partitions.items()))}
+    if manifest == old_manifest:
+        return False
+    write_text_atomically(manifest_path, json.dumps(manifest, indent=1))
+    return True
+
+
+def _new_deltas(date_path_pairs, state: Dict,
+                dates_to_append: Optional[List[str]]) -> Tuple[Optional[pd.DataFrame], List]:
+    """
+    Returns the deltas of dates_to_append (computed using the context stored in
+    the state) or of all dates if dates_to_append is None, together with the
+    context to store in the new state; the deltas are None if there's nothing
+    to add.
+    """
+    if dates_to_append is None:
+        dates, context = [date for date, _ in date_path_pairs], None
+    else:
+        dates = dates_to_append
+        context = pd.DataFrame(state['context']).set_index(INDEX_NAMES)
+    if not dates:
+        return None, state.get('context')
+
+    path_by_date = dict(date_path_pairs)
+    cumulative = pd.concat([_read_date_dataset(date, path_by_date[date]) for date in dates])
+    deltas = compute_deltas(cumulative, context)
+    new_context = deltas_context(pd.concat([context, cumulative[context.columns]])
+                                 if context is not None else cumulative)
+    return deltas, new_context.reset_index().to_dict(orient='records')
+
+
+def make_deltas_dataset(input_dir=DATA_BY_DATE_DIR,
+                        output_dir=FULL_DATASET_DIR,
+                        state_path=DELTAS_DATASET_STATE_PATH,
+                        digest_index: Optional[FileIndex] = None,
+                        metrics: Optional[Metrics] = None):
+    """
+    Makes the dataset of daily deltas and rolling averages (see deltas.py) next
+    to the full dataset.
+
+    Like the incremental mode of make_full_dataset, only the rows of new dates
+    are computed and appended; the state file stores, besides the digests of the
+    single-date datasets, the last rows of the full dataset needed for computing
+    the deltas of the next dates.
+    """
+    date_path_pairs = list_datasets_by_date(input_dir)
+    if not date_path_pairs:
+        print('No datasets found in', input_dir)
+        return False
+
+    out_path = get_deltas_dataset_path(dirpath=output_dir)
+    digest_index = digest_index or FileIndex(FILE_DIGEST_INDEX_PATH)
+    digests = {date: digest_index.digest(path) for date, path in date_path_pairs}
+    state = load_json_or_empty(state_path)
+
+    dates_to_append = _dates_to_append(state, digests, out_path)
+    deltas, context = _new_deltas(date_path_pairs, state, dates_to_append)
+    if deltas is None:
+        print('Deltas dataset is up to date')
+        return out_path
+
+    if dates_to_append is None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        deltas.to_csv(out_path)
+    else:
+        with open(out_path, 'a', newline='') as f:
+            deltas.to_csv(f, header=False)
+    print('Dates added to the deltas dataset:', list(deltas.index.unique(level='date')))
+    if metrics:
+        metrics.count('deltas_rows_written', len(deltas))
+
+    state = {'output': _file_stat(out_path), 'digests': digests, 'context': context}
+    write_text_atomically(state_path, json.dumps(state, indent=1))
+    print('Deltas dataset written to', out_path)
+    return out_path
+
+
+def make_partitioned_deltas_dataset(input_dir=DATA_BY_DATE_DIR,
+                                    output_dir=DELTAS_DATASET_PARTITIONS_DIR,
+                                    state_path=DELTAS_DATASET_PARTITIONS_STATE_PATH,
+                                    digest_index: Optional[FileIndex] = None,
+                                    metrics: Optional[Metrics] = None) -> List[Path]:
+    """
+    Like make_deltas_dataset but the dataset is split in monthly partitions with
+    a manifest (like make_partitioned_full_dataset). The rows of new dates are
+    appended to the partition of their month, so daily updates touch only that
+    partition and the manifest. Returns the paths of the files that were written
+    or deleted (i.e. the files to commit).
+    """
+    date_path_pairs = list_datasets_by_date(input_dir)
+    if not date_path_pairs:
+        print('No datasets found in', input_dir)
+        return []
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(output_dir, PARTITIONS_MANIFEST_FNAME)
+    digest_index = digest_index or FileIndex(FILE_DIGEST_INDEX_PATH)
+    digests = {date: digest_index.digest(path) for date, path in date_path_pairs}
+    state = load_json_or_empty(state_path)
+    old_manifest = load_json_or_empty(manifest_path)
+
+    outputs = state.get('outputs')
+    outputs_unchanged = outputs is not None and all(
+        Path(stat['path']).exists() and _file_stat(Path(stat['path'])) == stat
+        for stat in outputs.values())
+    dates_to_append = _new_dates(state, digests) if outputs_unchanged else None
+    deltas, context = _new_deltas(date_path_pairs, state, dates_to_append)
+    if deltas is None:
+        print('Deltas dataset partitions are up to date')
+        return []
+
+    append = dates_to_append is not None
+    partitions = dict(old_manifest.get('partitions', {})) if append else {}
+    outputs = dict(outputs) if append else {}
+    changed_paths = []
+    months = deltas.index.get_level_values('date').str[:7]
+    for month, rows in deltas.groupby(months, sort=True):
+        out_path = get_deltas_dataset_partition_path(month, dirpath=output_dir)
+        old = partitions.get(month)
+        if old is not None:
+            with open(out_path, 'a', newline='') as f:
+                rows.to_csv(f, header=False)
+        else:
+            with atomic_output(out_path) as tmp_path, open(tmp_path, 'w', newline='') as f:
+                rows.to_csv(f)
+        partitions[month] = {
+            'file': out_path.name,
+            'dates': (old['dates'] if old else []) + list(rows.index.unique(level='date')),
+            'rows': (old['rows'] if old else 0) + len(rows),
+            'sha1': digest_index.digest(out_path),
+        }
+        outputs[month] = _file_stat(out_path)
+        changed_paths.append(out_path)
+        print('Deltas dataset partition written to', out_path)
+    if metrics:
+        metrics.count('deltas_rows_written', len(deltas))
+
+    for month in set(old_manifest.get('partitions', {})) - set(partitions):
+        path = Path(output_dir, old_manifest['partitions'][month]['file'])
+        if path.exists():
+            path.unlink()
+            changed_paths.append(path)
+        print('Deltas dataset partition removed:', path)
+
+    if _write_partitions_manifest(manifest_path, partitions, old_manifest):
+        changed_paths.append(manifest_path)
+    state = {'outputs': outputs, 'digests': digests, 'context': context}
+    write_text_atomically(state_path, json.dumps(state, indent=1))
+    return changed_paths
+
+
 if __name__ == '__main__':
-    from download_reports import download_missing_reports
+    import argparse
+    from download_reports import download_missing_reports, iter_downloaded_reports
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', type=int, default=1, help='number of processes used for extracting tables')
+    parser.add_argument(
+        '--engine', choices=EXTRACTION_ENGINES, default='pypdf', help='table extraction engine')
+    parser.add_argument(
+        '--remake', action='store_true',
+        help='remake existing datasets (tables are re-extracted only if not cached)')
+    parser.add_argument(
+        '--dates', nargs='*', default=None, help='make only the datasets of these dates')
+    parser.add_argument(
+        '--partitioned', action='store_true',
+        help='write the full and deltas datasets split in monthly partitions too')
+    parser.add_argument(
+        '--pipelined', action='store_true',
+        help='make the datasets of reports while new reports are being downloaded')
+    args = parser.parse_args()
 
-    download_missing_reports()
-    make_single_date_datasets()
+    if args.pipelined:
+        report_paths = chain(sorted(ISS_REPORTS_DIR.glob('*.pdf')), iter_downloaded_reports())
+        make_single_date_datasets_pipelined(report_paths, table_extractor=args.engine,
+                                            workers=args.workers, skip_existing=not args.remake,
+                                            cache=ExtractionCache(), dates=args.dates)
+    else:
+        download_missing_reports()
+        make_single_date_datasets(table_extractor=args.engine, workers=args.workers,
+                                  skip_existing=not args.remake, cache=ExtractionCache(),
+                                  dates=args.dates)
     make_full_dataset()
+    make_deltas_dataset()
+    if args.partitioned:
+        make_partitioned_full_dataset()
+        make_partitioned_deltas_dataset()
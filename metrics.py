@@ -0,0 +1,79 @@
+"""
+Minimal instrumentation for the update pipeline: durations of stages, counters
+(e.g. downloaded bytes) and per-item records (e.g. one per extracted report).
+Metrics of a run can be appended to a JSON-lines file and summarized in text
+(e.g. for notifications).
+"""
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    List
+)
+
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages: List[Dict[str, Any]] = []
+        self.counters: Dict[str, float] = {}
+        self.records: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Context manager measuring the duration of a stage. A stage timed inside
+        another one is named "{parent}.{name}" (e.g. "download.scrape"), so that
+        it's not counted twice in the total.
+        """
+        stage = {'stage': name, 'seconds': 0.0, 'ok': False}
+        self.stages.append(stage)  # in order of start, so that a stage precedes its sub-stages
+        start = time.perf_counter()
+        try:
+            yield
+            stage['ok'] = True
+        finally:
+            stage['seconds'] = round(time.perf_counter() - start, 4)
+
+    def count(self, name: str, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, kind: str, **fields):
+        self.records.append({'kind': kind, **fields})
+
+    def to_json_lines(self) -> str:
+        run = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at))
+        lines = [{'run': run, 'type': 'stage', **stage} for stage in self.stages]
+        lines += [{'run': run, 'type': 'record', **record} for record in self.records]
+        lines.append({'run': run, 'type': 'counters', **self.counters})
+        return ''.join(json.dumps(line) + '\n' for line in lines)
+
+    def write_json_lines(self, path: Path):
+        """ Appends the metrics of this run to a JSON-lines file """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(self.to_json_lines())
+
+    def total_seconds(self) -> float:
+        """ Sum of the durations of the stages that are not nested in other stages """
+        return round(sum(s['seconds'] for s in self.stages if '.' not in s['stage']), 4)
+
+    def summary(self) -> str:
+        lines = ['Stages:']
+        for s in self.stages:
+            indent = '  ' * (1 + s['stage'].count('.'))
+            lines.append('{}{:<16} {:8.2f}s{}'.format(
+                indent, s['stage'], s['seconds'], '' if s['ok'] else '  FAILED'))
+        lines.append('  {:<16} {:8.2f}s'.format('total', self.total_seconds()))
+        if self.counters:
+            lines.append('Counters:')
+            lines += [f'  {name:<24} {value}' for name, value in self.counters.items()]
+        if self.records:
+            lines.append('Records:')
+            lines += ['  ' + ', '.join(f'{k}={v}' for k, v in record.items())
+                      for record in self.records]
+        return '\n'.join(lines)
@@ -0,0 +1,127 @@
+"""
+Profiles the extraction of the tables from all reports (or the reports of some
+dates): for each report, the time spent in each stage of the extraction (see
+PROFILE_STAGES), the number of pages scanned and the number of tokens are
+collected in a DataFrame; outliers are the reports that are much slower than
+the others in some stage::
+
+    python profile_extraction.py --engine stream --output profile.csv
+"""
+import time
+from pathlib import Path
+from typing import (
+    Iterable,
+    Optional,
+    Union
+)
+
+import numpy
+import pandas as pd
+
+from make_datasets import EXTRACTION_ENGINES, get_table_extractor
+from settings import ISS_REPORTS_DIR, get_date_from_filename
+from table_extraction.common import PROFILE_STAGES, TableExtractor
+
+TIME_COLUMNS = [stage + '_seconds' for stage in PROFILE_STAGES]
+PROFILE_COLUMNS = [*TIME_COLUMNS, 'seconds', 'pages_scanned', 'table_page', 'tokens', 'error']
+OUTLIER_COLUMNS = ['date', 'column', 'value', 'median', 'ratio']
+
+
+def profile_extraction(reports_dir: Path = ISS_REPORTS_DIR,
+                       table_extractor: Union[TableExtractor, str] = 'pypdf',
+                       dates: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Extracts the table of each report (ignoring the page index and the extraction
+    cache) and returns a DataFrame indexed by date with PROFILE_COLUMNS; seconds
+    is the total time of the extraction.
+    """
+    if isinstance(table_extractor, str):
+        table_extractor = get_table_extractor(table_extractor, page_index_path=None)
+    table_extractor.profile = True
+    dates = set(dates) if dates is not None else None
+    rows = []
+    for path in sorted(reports_dir.glob('*.pdf')):
+        date = get_date_from_filename(path.name)
+        if dates is not None and date not in dates:
+            continue
+        stats = {'date': date}
+        start = time.perf_counter()
+        try:
+            table_extractor(path, date, stats)
+        except Exception as exc:
+            stats['error'] = repr(exc)
+        stats['seconds'] = time.perf_counter() - start
+        rows.append(stats)
+    profile = pd.DataFrame(rows, columns=['date', *PROFILE_COLUMNS]).set_index('date')
+    profile[TIME_COLUMNS] = profile[TIME_COLUMNS].fillna(0.0)
+    return profile
+
+
+def find_outliers(profile: pd.DataFrame, threshold=3.0, min_ratio=1.5) -> pd.DataFrame:
+    """
+    Returns a row for each (report, column) whose value is an outlier, i.e. its
+    distance from the median of the column is more than threshold times the
+    (normalized) median absolute deviation and the value is at least min_ratio
+    times the median. Columns are the time columns, pages_scanned and tokens.
+    Rows are sorted by decreasing ratio (see OUTLIER_COLUMNS).
+    """
+    columns = [*TIME_COLUMNS, 'seconds', 'pages_scanned', 'tokens']
+    values = profile[columns].astype(float)
+    median = values.median()
+    mad = (values - median).abs().median() * 1.4826
+    ratio = values / median.where(median > 0)
+    is_outlier = ((values - median > threshold * mad.where(mad > 0, numpy.inf))
+                  & (ratio >= min_ratio))
+    rows, cols = numpy.nonzero(is_outlier.to_numpy())
+    outliers = pd.DataFrame({
+        'date': profile.index[rows],
+        'column': values.columns[cols],
+        'value': values.to_numpy()[rows, cols],
+        'median': median.to_numpy()[cols],
+        'ratio': ratio.to_numpy()[rows, cols],
+    }, columns=OUTLIER_COLUMNS)
+    return outliers.sort_values('ratio', ascending=False, ignore_index=True)
+
+
+def print_report(profile: pd.DataFrame, outliers: pd.DataFrame, max_outliers=30):
+    stats = profile[[*TIME_COLUMNS, 'seconds', 'pages_scanned', 'tokens']]
+    print(stats.describe(percentiles=[0.5, 0.9, 0.99]).T.to_string(float_format='{:.4g}'.format))
+    print()
+    errors = profile['error'].dropna()
+    if len(errors):
+        print(f'{len(errors)} extraction(s) failed:')
+        print(errors.to_string())
+        print()
+    if outliers.empty:
+        print('No outliers found')
+        return
+    print(f'{len(outliers)} outlier(s):')
+    print(outliers.head(max_outliers).to_string(index=False, float_format='{:.4g}'.format))
+    if len(outliers) > max_outliers:
+        print(f'... ({len(outliers) - max_outliers} more)')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--reports-dir', type=Path, default=ISS_REPORTS_DIR, help='folder of the reports')
+    parser.add_argument(
+        '--engine', choices=EXTRACTION_ENGINES, default='pypdf', help='table extraction engine')
+    parser.add_argument(
+        '--dates', nargs='*', default=None, help='profile only the reports of these dates')
+    parser.add_argument(
+        '--threshold', type=float, default=3.0,
+        help='min distance of outliers from the median, in (normalized) median absolute '
+             'deviations')
+    parser.add_argument(
+        '--output', type=Path, default=None,
+        help='write the profile of each report to this CSV file')
+    args = parser.parse_args()
+
+    profile = profile_extraction(args.reports_dir, args.engine, args.dates)
+    print_report(profile, find_outliers(profile, args.threshold))
+    if args.output:
+        profile.to_csv(args.output)
+        print('Profile written to', args.output)
@@ -8,12 +8,33 @@ ISS_REPORT_FNAME = '{date}.pdf'
 ISS_REPORT_MIN_DATE = '2020-03-12'  # the report before this date doesn't contain the data we are looking for
 TABULA_TEMPLATES_DIR = Path(PROJECT_DIR, 'tabula-templates')
 
+CACHE_DIR = Path(PROJECT_DIR, '.cache')
+TABLE_PAGE_INDEX_PATH = Path(CACHE_DIR, 'table-pages.json')  # page of the table in each report
+TABULA_TEMPLATE_PLANS_PATH = Path(CACHE_DIR, 'tabula-template-plans.json')  # compiled templates
+FILE_DIGEST_INDEX_PATH = Path(CACHE_DIR, 'file-digests.json')
+FULL_DATASET_MANIFEST_PATH = Path(CACHE_DIR, 'full-dataset-manifest.json')
+FULL_DATASET_QUERY_INDEX_PATH = Path(CACHE_DIR, 'full-dataset-index.json')  # see dataset_query.py
+FULL_DATASET_FEATHER_PATH = Path(CACHE_DIR, 'iccas_full.feather')  # not published (see columnar.py)
+DELTAS_DATASET_STATE_PATH = Path(CACHE_DIR, 'deltas-dataset-state.json')
+FULL_DATASET_PARTITIONS_STATE_PATH = Path(CACHE_DIR, 'full-dataset-partitions-state.json')
+DELTAS_DATASET_PARTITIONS_STATE_PATH = Path(CACHE_DIR, 'deltas-dataset-partitions-state.json')
+EXTRACTION_CACHE_DIR = Path(CACHE_DIR, 'tables')  # tables extracted from reports
+ISS_NEWS_PAGE_STATE_PATH = Path(CACHE_DIR, 'iss-news-page.json')  # for conditional requests
+
+METRICS_PATH = Path(PROJECT_DIR, 'logs', 'metrics.jsonl')  # metrics of update_data.py runs
+
 DATA_REPO = Path(PROJECT_DIR, 'iccas-dataset')
 DATA_DIR = Path(DATA_REPO, 'data')
 DATA_BY_DATE_DIR = Path(DATA_DIR, 'by-date')
 DATE_DATASET_FNAME = 'iccas_{date}'
 FULL_DATASET_DIR = DATA_DIR
 FULL_DATASET_FNAME = 'iccas_full'
+DELTAS_DATASET_FNAME = 'iccas_deltas'  # daily deltas and rolling averages (see deltas.py)
+FULL_DATASET_PARTITIONS_DIR = Path(DATA_DIR, 'full-by-month')  # full dataset split by month
+FULL_DATASET_PARTITION_FNAME = 'iccas_full_{month}'
+DELTAS_DATASET_PARTITIONS_DIR = Path(DATA_DIR, 'deltas-by-month')  # deltas dataset split by month
+DELTAS_DATASET_PARTITION_FNAME = 'iccas_deltas_{month}'
+PARTITIONS_MANIFEST_FNAME = 'manifest.json'  # in each folder of partitions
 
 _DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
 
@@ -35,3 +56,15 @@ def get_single_date_dataset_path(date, dirpath=DATA_BY_DATE_DIR, ext='.csv'):
 
 def get_full_dataset_path(dirpath=FULL_DATASET_DIR, ext='.csv'):
     return Path(dirpath, FULL_DATASET_FNAME + ext)
+
+
+def get_deltas_dataset_path(dirpath=FULL_DATASET_DIR, ext='.csv'):
+    return Path(dirpath, DELTAS_DATASET_FNAME + ext)
+
+
+def get_full_dataset_partition_path(month, dirpath=FULL_DATASET_PARTITIONS_DIR, ext='.csv'):
+    return Path(dirpath, FULL_DATASET_PARTITION_FNAME.format(month=month) + ext)
+
+
+def get_deltas_dataset_partition_path(month, dirpath=DELTAS_DATASET_PARTITIONS_DIR, ext='.csv'):
+    return Path(dirpath, DELTAS_DATASET_PARTITION_FNAME.format(month=month) + ext)
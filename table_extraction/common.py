@@ -1,7 +1,23 @@
 import abc
 import math
+import mmap
 import re
-from typing import Tuple
+import time
+from contextlib import contextmanager, nullcontext
+from itertools import chain
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union
+)
 
 import PyPDF3
 import numpy
@@ -38,31 +54,284 @@ COLUMN_CONVERTERS = [str] + [to_int, to_float, to_int, to_float, to_float] * 3
 CONVERTER_BY_COLUMN = dict(zip(COLUMNS, COLUMN_CONVERTERS))
 
 
+# Tokens are joined with newlines (which can't be part of valid numbers) and parsed at once
+_INT_TOKENS = re.compile(r'[0-9]+(?:\n[0-9]+)*')
+_FLOAT_TOKENS = re.compile(r'[0-9]+(?:\.[0-9]+)?(?:\n[0-9]+(?:\.[0-9]+)?)*')
+
+
+def _parse_ints(tokens: List[str]) -> numpy.ndarray:
+    """
+    Vectorized to_int() for non-blank tokens. Tokens are parsed all at once by
+    numpy if they are plain numbers, otherwise they are converted one by one.
+    """
+    text = '\n'.join(tokens).replace('.', '').replace(' ', '')
+    if tokens and _INT_TOKENS.fullmatch(text):
+        return numpy.fromstring(text, dtype=numpy.int64, sep='\n')
+    return numpy.array([to_int(token) for token in tokens], dtype=numpy.int64)
+
+
+def _parse_floats(tokens: List[str]) -> numpy.ndarray:
+    """ Vectorized to_float() for non-blank tokens (see _parse_ints) """
+    text = '\n'.join(tokens).replace(',', '.')
+    if tokens and _FLOAT_TOKENS.fullmatch(text):
+        return numpy.fromstring(text, dtype=numpy.float64, sep='\n')
+    return numpy.array([to_float(token) for token in tokens], dtype=numpy.float64)
+
+
+# Converters of blank tokens to NaN that have a vectorized version
+VECTORIZED_CONVERTERS = {to_int: _parse_ints, to_float: _parse_floats}
+
+
+def convert_token_grid(tokens, columns=COLUMNS, converters=COLUMN_CONVERTERS) -> pd.DataFrame:
+    """
+    Converts a grid of string tokens, i.e. a sequence of rows or a flat sequence
+    of tokens (row after row), to a DataFrame, with the same results of applying
+    the converters to each token (e.g. int64 columns become float64 if they
+    contain blanks). The tokens of all the columns having the same converter are
+    parsed at once (see VECTORIZED_CONVERTERS), so the grid can contain the rows
+    of many tables.
+    """
+    grid = numpy.array(tokens, dtype=object)
+    if grid.ndim == 1 and grid.size % len(columns) == 0:
+        grid = grid.reshape(-1, len(columns))
+    if grid.ndim != 2 or grid.shape[1] != len(columns):
+        raise TableExtractionError('the grid of tokens has not %d columns' % len(columns))
+
+    data = {}
+    for converter in dict.fromkeys(converters):
+        indexes = [j for j, conv in enumerate(converters) if conv is converter]
+        if converter not in VECTORIZED_CONVERTERS:
+            for j in indexes:
+                data[columns[j]] = [converter(token) for token in grid[:, j]]
+            continue
+        block = grid[:, indexes].T
+        blank = block == ''
+        values = VECTORIZED_CONVERTERS[converter](block[~blank].tolist())
+        ends = numpy.cumsum((~blank).sum(axis=1))
+        for j, column_blank, column_values in zip(indexes, blank, numpy.split(values, ends[:-1])):
+            if column_blank.any():
+                column = numpy.full(len(column_blank), math.nan)
+                column[~column_blank] = column_values
+                column_values = column
+            data[columns[j]] = column_values
+    return pd.DataFrame({col: data[col] for col in columns}, copy=False)
+
+
+class ExtractionOutcome(NamedTuple):
+    table: Optional[pd.DataFrame]
+    stats: dict
+    exception: Optional[Exception]
+
+
+# Stages of the extraction timed when profiling (see TableExtractor.profile)
+PROFILE_STAGES = ('open', 'page_scan', 'text_extraction', 'tokenization', 'conversion')
+
+
+@contextmanager
+def _timed(stats: dict, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        key = stage + '_seconds'
+        stats[key] = stats.get(key, 0) + time.perf_counter() - start
+
+
+def _timed_function(fn: Callable, stats: dict, stage: str) -> Callable:
+    def timed_fn(*args, **kwargs):
+        with _timed(stats, stage):
+            return fn(*args, **kwargs)
+    return timed_fn
+
+
 class TableExtractor(abc.ABC):
+    # Must be increased when a change in the code can change the extracted tables
+    version = '1'
+    # If True, extract_many() is more efficient than calling extract() for each report
+    batched = False
+    # If True, extract() stores the time spent in each of PROFILE_STAGES in
+    # stats['{stage}_seconds'] (see profile_extraction.py)
+    profile = False
+    page_index = None
+
     @abc.abstractmethod
-    def extract(self, path, report_date):
-        pass
+    def extract(self, path, report_date, stats: Optional[dict] = None):
+        """
+        Returns the table of the report (a path or a ReportHandle) as a
+        pd.DataFrame. If a stats dictionary is passed, it's filled with info
+        about the extraction (e.g. the number of scanned pages).
+        """
+
+    def profiled(self, stats: Optional[dict], stage: str) -> ContextManager:
+        """ Times the block as a stage of the extraction if profiling is enabled """
+        if not self.profile or stats is None:
+            return nullcontext()
+        return _timed(stats, stage)
+
+    def find_table_page(self, report: 'ReportHandle', stats: Optional[dict] = None,
+                        extract_text: Optional[Callable[[PageObject], str]] = None,
+                        **kwargs) -> 'TablePage':
+        """
+        Calls find_table_page() with self.page_index, profiling the parsing of
+        the PDF (open), the whole search (page_scan) and the text extraction
+        """
+        extract_text = extract_text or extract_page_text
+        if self.profile and stats is not None:
+            with _timed(stats, 'open'):
+                report.num_pages  # parses the xref table and the page tree
+            extract_text = _timed_function(extract_text, stats, 'text_extraction')
+        with self.profiled(stats, 'page_scan'):
+            return find_table_page(report, self.page_index, stats, extract_text, **kwargs)
+
+    def __call__(self, path, report_date, stats: Optional[dict] = None):
+        return self.extract(path, report_date, stats)
+
+    def config(self) -> dict:
+        """ Returns the (JSON-serializable) configuration affecting the extracted tables """
+        return {
+            'columns': COLUMNS,
+            'converters': [converter.__name__ for converter in COLUMN_CONVERTERS],
+        }
 
-    def __call__(self, path, report_date):
-        return self.extract(path, report_date)
+    def extract_many(self, items: Iterable[Tuple[Any, str]]) -> List[ExtractionOutcome]:
+        """
+        Extracts the table of each (path, report_date) item. Exceptions are not
+        raised but returned in the outcome of each item.
+        """
+        outcomes = []
+        for path, report_date in items:
+            stats = {}
+            try:
+                table = self.extract(path, report_date, stats)
+                outcomes.append(ExtractionOutcome(table, stats, None))
+            except Exception as exc:
+                outcomes.append(ExtractionOutcome(None, stats, exc))
+        return outcomes
 
 
 class TableExtractionError(Exception):
     pass
 
 
-def find_table_page(pdf_path) -> Tuple[PageObject, int]:
-    """ Return the (1-based) index of the page containing the table table. """
-    pdf = PyPDF3.PdfFileReader(str(pdf_path))
-    num_pages = pdf.getNumPages()
+class ReportHandle:
+    """
+    An open report, which can be passed to find_table_page() and to extractors
+    in place of its path, so that the PDF is opened and parsed only once.
 
-    for i in range(1, num_pages):  # skip the first page, the table is certainly not there
-        page = pdf.getPage(i)
-        text = page.extractText().replace('\n', '')
-        if TABLE_CAPTION_PATTERN.search(text):
-            return page, i + 1  # return a 1-based index
+    The file is memory-mapped and the PdfFileReader is created on first use, so
+    only the parts of the file that are actually parsed (the xref table and the
+    objects of the pages that are used) are read.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._data: Optional[mmap.mmap] = None
+        self._reader: Optional[PyPDF3.PdfFileReader] = None
+
+    @property
+    def data(self) -> mmap.mmap:
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    @property
+    def reader(self) -> PyPDF3.PdfFileReader:
+        if self._reader is None:
+            self._reader = PyPDF3.PdfFileReader(self.data)
+        return self._reader
+
+    @property
+    def num_pages(self) -> int:
+        return self.reader.getNumPages()
+
+    def page(self, number: int) -> PageObject:
+        """ Returns the page given its 1-based number """
+        return self.reader.getPage(number - 1)
+
+    def close(self):
+        """ Closes the file; pages returned by page() can't be used anymore """
+        self._reader = None
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f'ReportHandle({str(self.path)!r})'
+
+
+def open_report(report: Union[ReportHandle, str, Path]) -> ReportHandle:
+    """ Returns report if it's already a ReportHandle, otherwise a new handle for the path """
+    return report if isinstance(report, ReportHandle) else ReportHandle(report)
+
+
+@contextmanager
+def opened_report(report: Union[ReportHandle, str, Path]) -> Iterator[ReportHandle]:
+    """ Like open_report() but the handle is closed at the end if it was created here """
+    if isinstance(report, ReportHandle):
+        yield report
     else:
-        raise TableExtractionError('could not find the table in the pdf')
+        with ReportHandle(report) as handle:
+            yield handle
+
+
+class TablePage(NamedTuple):
+    page: PageObject
+    number: int  # 1-based
+    text: str  # extracted text with newlines removed
+
+
+def extract_page_text(page: PageObject) -> str:
+    # For some reason, the extracted text contains a lot of superfluous newlines
+    return page.extractText().replace('\n', '')
+
+
+def find_table_page(pdf_path, page_index=None, stats: Optional[dict] = None,
+                    extract_text: Callable[[PageObject], str] = extract_page_text,
+                    expected_page: Optional[int] = None) -> TablePage:
+    """
+    Returns the page containing the table together with its (1-based) index and
+    its text. pdf_path can be a ReportHandle, so that the parsed PDF can be
+    reused after this call.
+
+    If page_index (a file_index.FileIndex) is provided, the page stored in the
+    index for this pdf is tried first; when the page has to be searched, its
+    number is stored in the index. If expected_page is provided (e.g. the page
+    of the table in other reports with the same layout), it's tried before
+    scanning all pages.
+
+    If stats is provided, the number of pages whose text was extracted is stored
+    in stats['pages_scanned']. The text of pages is extracted with extract_text.
+    """
+    report = open_report(pdf_path)
+    num_pages = report.num_pages
+    if stats is None:
+        stats = {}
+    stats['pages_scanned'] = 0
+
+    indexed_page = None
+    if page_index is not None:
+        entry = page_index.lookup(report.path)
+        indexed_page = entry.get('table_page') if entry else None
+    candidates = [number for number in dict.fromkeys([indexed_page, expected_page])
+                  if number and 0 < number <= num_pages]
+    pages_to_scan = range(2, num_pages + 1)  # skip the first page, the table is certainly not there
+    for number in chain(candidates, (n for n in pages_to_scan if n not in candidates)):
+        page = report.page(number)
+        text = extract_text(page)
+        stats['pages_scanned'] += 1
+        if TABLE_CAPTION_PATTERN.search(text):
+            if page_index is not None and number != indexed_page:
+                page_index.update(report.path, table_page=number)
+            stats['table_page'] = number
+            return TablePage(page, number, text)
+    raise TableExtractionError('could not find the table in the pdf')
 
 
 def normalize_table(table: pd.DataFrame) -> pd.DataFrame:
@@ -73,35 +342,93 @@ def normalize_table(table: pd.DataFrame) -> pd.DataFrame:
     return table
 
 
-def recompute_derived_columns(x: pd.DataFrame) -> pd.DataFrame:
-    """ Recompute all derived columns """
-    derived_cols = list(cartesian_join(
-        COLUMN_PREFIXES, ['cases_percentage', 'deaths_percentage', 'fatality_rate']))
-    y = x.drop(columns=derived_cols)  # to avoid SettingWithCopy warning
-
-    total_cases = x['cases'].sum()
-    total_deaths = x['deaths'].sum()
-    y['cases_percentage'] = x['cases'] / total_cases * 100
-    y['deaths_percentage'] = x['deaths'] / total_deaths * 100
+DERIVED_COLUMNS = list(cartesian_join(
+    COLUMN_PREFIXES, ['cases_percentage', 'deaths_percentage', 'fatality_rate']))
+
+
+class DerivedColumnsMismatch(TableExtractionError):
+    def __init__(self, mismatches: pd.DataFrame):
+        self.mismatches = mismatches
+        super().__init__('%d derived value(s) are inconsistent with the recomputed ones:\n%s'
+                         % (len(mismatches), mismatches.to_string()))
+
+
+def compute_derived_columns(x: pd.DataFrame, by=None) -> pd.DataFrame:
+    """
+    Returns a DataFrame (with the same index of x) containing the derived columns
+    computed from the count columns of x. If x contains multiple tables (e.g. the
+    full dataset), by must be the index level identifying each table (e.g. 'date'),
+    so that the totals used for the percentages are computed per table.
+    """
+    def total(col):
+        return x[col].sum() if by is None else x.groupby(level=by)[col].transform('sum')
+
+    y = pd.DataFrame(index=x.index)
+    y['cases_percentage'] = x['cases'] / total('cases') * 100
+    y['deaths_percentage'] = x['deaths'] / total('deaths') * 100
     y['fatality_rate'] = x['deaths'] / x['cases'] * 100
 
     # REMEMBER: male_cases + female_cases != total_cases,
     # because total_cases also includes cases of unknown sex
     for what in ['cases', 'deaths']:
-        total = x[f'male_{what}'] + x[f'female_{what}']
-        denominator = total.replace(0, 1)  # avoid division by 0
+        total_by_sex = x[f'male_{what}'] + x[f'female_{what}']
+        denominator = total_by_sex.replace(0, 1)  # avoid division by 0
         for sex in ['male', 'female']:
             y[f'{sex}_{what}_percentage'] = x[f'{sex}_{what}'] / denominator * 100
 
     for sex in ['male', 'female']:
         y[f'{sex}_fatality_rate'] = x[f'{sex}_deaths'] / x[f'{sex}_cases'] * 100
 
+    return y[DERIVED_COLUMNS]
+
+
+def find_derived_columns_mismatches(x: pd.DataFrame, recomputed: pd.DataFrame,
+                                    atol=0.1) -> pd.DataFrame:
+    """
+    Returns a DataFrame with a row for each value of the derived columns of x
+    that is not close to the recomputed one (NaNs are never close), with columns
+    (column, original, recomputed) and the index of x.
+    """
+    original = x[DERIVED_COLUMNS].to_numpy(dtype=float)
+    new = recomputed[DERIVED_COLUMNS].to_numpy(dtype=float)
+    rows, cols = numpy.nonzero(~numpy.isclose(new, original, atol=atol))
+    return pd.DataFrame({
+        'column': numpy.array(DERIVED_COLUMNS)[cols],
+        'original': original[rows, cols],
+        'recomputed': new[rows, cols],
+    }, index=x.index[rows])
+
+
+def recompute_derived_columns(x: pd.DataFrame) -> pd.DataFrame:
+    """ Recompute all derived columns """
+    derived = compute_derived_columns(x)
+
     # sanity check
-    for col in derived_cols:
-        assert numpy.allclose(y[col], x[col], atol=0.1), \
-            '\n' + str(pd.DataFrame({'recomputed': y[col], 'original': x[col]}))
+    for col in DERIVED_COLUMNS:
+        assert numpy.allclose(derived[col], x[col], atol=0.1), \
+            '\n' + str(pd.DataFrame({'recomputed': derived[col], 'original': x[col]}))
+
+    y = x.copy()
+    y[DERIVED_COLUMNS] = derived
+    return y
+
 
-    return y[x.columns]
+def recompute_derived_columns_batch(full: pd.DataFrame, check=True, atol=0.1,
+                                    by='date') -> pd.DataFrame:
+    """
+    Recompute all derived columns of multiple tables stacked in a single DataFrame
+    (e.g. the full dataset, indexed by (date, age_group)) in one vectorized pass.
+    If check is True, raises DerivedColumnsMismatch reporting all the original
+    values that are inconsistent with the recomputed ones.
+    """
+    derived = compute_derived_columns(full, by=by)
+    if check:
+        mismatches = find_derived_columns_mismatches(full, derived, atol=atol)
+        if len(mismatches):
+            raise DerivedColumnsMismatch(mismatches)
+    y = full.copy()
+    y[DERIVED_COLUMNS] = derived
+    return y
 
 
 def sanity_check_with_totals(table: pd.DataFrame, totals):
@@ -1,38 +1,46 @@
 import re
+from typing import Optional
 
 import pandas as pd
+from PyPDF3.pdf import PageObject
 
 from table_extraction.common import (
+    TableExtractionError,
     TableExtractor,
-    find_table_page,
     COLUMNS,
-    COLUMN_CONVERTERS,
-    normalize_table
+    convert_token_grid,
+    extract_page_text,
+    normalize_table,
+    opened_report
 )
 
 
 class PyPDFTableExtractor(TableExtractor):
     unknown_age_matcher = re.compile('(età non nota|non not[ao])', flags=re.IGNORECASE)
 
-    def extract(self, path, report_date: str) -> pd.DataFrame:
-        page, _ = find_table_page(path)
-        # For some reason, the extracted text contains a lot of superfluous newlines
-        text = page.extractText().replace('\n', '')
-        text = self.unknown_age_matcher.sub('unknown', text)
-        start = text.find('0-9')
-        text = text[start:]
-        text = text.replace(', ', ',')   # from 28/09, they write "1,5" as "1, 5"
-        tokens = text.split(' ')
+    def __init__(self, page_index=None):
+        self.page_index = page_index
+
+    def page_text(self, page: PageObject) -> str:
+        """ Returns the text of the page (without newlines) """
+        return extract_page_text(page)
+
+    def extract(self, path, report_date: str, stats: Optional[dict] = None) -> pd.DataFrame:
+        with opened_report(path) as report:
+            text = self.find_table_page(report, stats, extract_text=self.page_text).text
+        with self.profiled(stats, 'tokenization'):
+            text = self.unknown_age_matcher.sub('unknown', text)
+            start = text.find('0-9')
+            text = text[start:]
+            text = text.replace(', ', ',')   # from 28/09, they write "1,5" as "1, 5"
+            tokens = text.split(' ')
+        if stats is not None:
+            stats['tokens'] = len(tokens)
         num_rows = 11
-        num_columns = len(COLUMNS)
-        rows = []
-        for i in range(num_rows):
-            start = i * num_columns
-            end = start + num_columns
-            row = tokens[start:end]
-            for j in range(num_columns):
-                row[j] = COLUMN_CONVERTERS[j](row[j])
-            rows.append(row)
-        df = pd.DataFrame(rows, columns=COLUMNS)
+        num_tokens = num_rows * len(COLUMNS)
+        if len(tokens) < num_tokens:
+            raise TableExtractionError('the table has less than %d values' % num_tokens)
+        with self.profiled(stats, 'conversion'):
+            df = convert_token_grid(tokens[:num_tokens])
 
         return normalize_table(df)
@@ -0,0 +1,251 @@
+"""
+Table extractor that gets the text of a page by tokenizing its content stream
+with regular expressions instead of using PyPDF3 PageObject.extractText(),
+which parses the content stream byte by byte and builds a PDF object for each
+operand and operator.
+
+The text returned by extract_text() is identical to the one returned by
+extractText(), so that ContentStreamTableExtractor returns the same tables of
+PyPDFTableExtractor.
+"""
+import codecs
+import re
+from typing import (
+    List,
+    Optional,
+    Tuple
+)
+
+from PyPDF3.generic import ArrayObject, _pdfDocEncoding
+from PyPDF3.pdf import PageObject
+
+from table_extraction.common import TableExtractionError
+from table_extraction.pypdf_extractor import PyPDFTableExtractor
+
+# Same sets of characters used by PyPDF3
+_WHITESPACE = re.compile(rb'[ \n\r\t\x00]*')
+_REGULAR_CHARS = re.compile(rb'[^\s()<>\[\]{}/%]*')
+_NUMBER = re.compile(rb'[+,\-.0-9]*')
+_EOL = re.compile(rb'[\r\n]')
+_STRING_SPECIAL_CHARS = re.compile(rb'[()\\]')
+_HEX_DIGITS_WHITESPACE = re.compile(rb'[0-9a-fA-F \n\r\t\x00]*')
+_INLINE_IMAGE_DATA = re.compile(rb'ID.')
+_INLINE_IMAGE_END = re.compile(rb'EI[ \n\r\t\x00]+(?=Q)')
+
+_STRING_ESCAPES = {
+    b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+    b'c': b'\\c',  # sic
+    b'(': b'(', b')': b')', b'/': b'/', b'\\': b'\\', b' ': b' ', b'%': b'%',
+    b'<': b'<', b'>': b'>', b'[': b'[', b']': b']', b'#': b'#', b'_': b'_',
+    b'&': b'&', b'$': b'$',
+}
+_OCTAL_ESCAPE = re.compile(rb'[0-9]{1,3}')
+
+_PDFDOC_TABLE = {i: c for i, c in enumerate(_pdfDocEncoding)}
+_NOT_PDFDOC_CHARS = re.compile(
+    b'[' + b''.join(re.escape(bytes([i])) for i, c in enumerate(_pdfDocEncoding)
+                    if c == '\u0000') + b']')
+
+
+class _Other:
+    """ Any operand that is not a string """
+
+
+_OTHER = _Other()
+
+
+def decode_string(raw: bytes) -> Optional[str]:
+    """
+    Returns the text of a string or None if it's a byte string (see
+    PyPDF3.createStringObject)
+    """
+    if raw.startswith(codecs.BOM_UTF16_BE):
+        try:
+            return raw.decode('utf-16')
+        except UnicodeDecodeError:
+            return None
+    if _NOT_PDFDOC_CHARS.search(raw):
+        return None
+    return raw.decode('latin-1').translate(_PDFDOC_TABLE)
+
+
+def _read_literal_string(data: bytes, pos: int) -> Tuple[bytes, int]:
+    """ Reads a (...) string starting at data[pos] == '(' """
+    parts = []
+    parens = 1
+    pos += 1
+    while True:
+        match = _STRING_SPECIAL_CHARS.search(data, pos)
+        if match is None:
+            raise TableExtractionError('content stream ended unexpectedly')
+        start = match.start()
+        parts.append(data[pos:start])
+        char = data[start:start + 1]
+        pos = start + 1
+        if char == b'(':
+            parens += 1
+            parts.append(char)
+        elif char == b')':
+            parens -= 1
+            if parens == 0:
+                return b''.join(parts), pos
+            parts.append(char)
+        else:  # backslash
+            char = data[pos:pos + 1]
+            pos += 1
+            if char in _STRING_ESCAPES:
+                parts.append(_STRING_ESCAPES[char])
+            elif char.isdigit():
+                digits = _OCTAL_ESCAPE.match(data, pos - 1).group()
+                pos += len(digits) - 1
+                if len(digits) < 3:
+                    # PyPDF3 consumes (and drops) the character after a short escape
+                    pos += 1
+                try:
+                    parts.append(chr(int(digits, base=8)).encode('latin-1'))
+                except (ValueError, UnicodeEncodeError):
+                    raise TableExtractionError('invalid octal escape in string: %r' % digits)
+            elif char and char in b'\n\r':
+                if data[pos:pos + 1] in (b'\n', b'\r'):
+                    pos += 1
+            else:
+                raise TableExtractionError('unexpected escaped string: %r' % char)
+
+
+def _read_hex_string(data: bytes, pos: int) -> Tuple[bytes, int]:
+    """ Reads a <...> string starting at data[pos] == '<' """
+    match = _HEX_DIGITS_WHITESPACE.match(data, pos + 1)
+    end = match.end()
+    if data[end:end + 1] != b'>':
+        raise TableExtractionError('invalid hex string in content stream')
+    digits = re.sub(rb'[ \n\r\t\x00]', b'', match.group())
+    if len(digits) % 2:
+        digits += b'0'
+    return bytes.fromhex(digits.decode('ascii')), end + 1
+
+
+def _read_operand(data: bytes, pos: int):
+    """
+    Reads an operand starting at data[pos] (not a whitespace). Returns the decoded
+    text (or None) for strings, a list for arrays and _OTHER for anything else.
+    """
+    char = data[pos:pos + 1]
+    if char == b'(':
+        raw, pos = _read_literal_string(data, pos)
+        return decode_string(raw), pos
+    if char == b'<':
+        if data[pos + 1:pos + 2] == b'<':
+            pos += 2
+            while True:
+                pos = _WHITESPACE.match(data, pos).end()
+                if data[pos:pos + 2] == b'>>':
+                    return _OTHER, pos + 2
+                if pos >= len(data):
+                    raise TableExtractionError('content stream ended unexpectedly')
+                _, pos = _read_operand(data, pos)
+        raw, pos = _read_hex_string(data, pos)
+        return decode_string(raw), pos
+    if char == b'[':
+        items = []
+        pos += 1
+        while True:
+            pos = _WHITESPACE.match(data, pos).end()
+            if data[pos:pos + 1] == b']':
+                return items, pos + 1
+            if pos >= len(data):
+                raise TableExtractionError('content stream ended unexpectedly')
+            item, pos = _read_operand(data, pos)
+            items.append(item)
+    if char == b'%':
+        pos = _skip_comment(data, pos)
+        pos = _WHITESPACE.match(data, pos).end()
+        return _read_operand(data, pos)
+    if char == b'/' or char.isalpha():  # name, boolean, null
+        return _OTHER, _REGULAR_CHARS.match(data, pos + 1).end()
+    end = _NUMBER.match(data, pos).end()
+    if end == pos:
+        raise TableExtractionError('unexpected character in content stream: %r' % char)
+    return _OTHER, end
+
+
+def _skip_comment(data: bytes, pos: int) -> int:
+    match = _EOL.search(data, pos)
+    return len(data) if match is None else match.end()
+
+
+def _skip_inline_image(data: bytes, pos: int) -> int:
+    """ Skips an inline image, starting after the BI operator, up to EI (excluded) """
+    start = _INLINE_IMAGE_DATA.search(data, pos)
+    end = _INLINE_IMAGE_END.search(data, start.end()) if start else None
+    if end is None:
+        raise TableExtractionError('unterminated inline image in content stream')
+    return end.start() + 2
+
+
+def iter_operations(data: bytes):
+    """ Yields (operands, operator) for each operation in the content stream """
+    operands: List = []
+    pos = 0
+    size = len(data)
+    while True:
+        pos = _WHITESPACE.match(data, pos).end()
+        if pos >= size:
+            return
+        char = data[pos:pos + 1]
+        if char.isalpha() or char == b"'" or char == b'"':
+            end = _REGULAR_CHARS.match(data, pos + 1).end()
+            operator = data[pos:end]
+            pos = end
+            if operator == b'BI':
+                pos = _skip_inline_image(data, pos)
+            else:
+                yield operands, operator
+            operands = []
+        elif char == b'%':
+            pos = _skip_comment(data, pos)
+        else:
+            operand, pos = _read_operand(data, pos)
+            operands.append(operand)
+
+
+def extract_text(data: bytes) -> str:
+    """ Returns the same text returned by PyPDF3 PageObject.extractText() """
+    parts = []
+    for operands, operator in iter_operations(data):
+        if operator == b'Tj':
+            if isinstance(operands[0], str):
+                parts.append(operands[0])
+                parts.append('\n')
+        elif operator == b'T*':
+            parts.append('\n')
+        elif operator == b"'":
+            parts.append('\n')
+            if isinstance(operands[0], str):
+                parts.append(operands[0])
+        elif operator == b'"':
+            if isinstance(operands[2], str):
+                parts.append('\n')
+                parts.append(operands[2])
+        elif operator == b'TJ':
+            parts.extend(item for item in operands[0] if isinstance(item, str))
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def get_content_data(page: PageObject) -> bytes:
+    """ Returns the (decoded) content stream of the page """
+    content = page['/Contents'].getObject()
+    if isinstance(content, ArrayObject):
+        return b''.join(stream.getObject().getData() for stream in content)
+    return content.getData()
+
+
+def extract_page_text(page: PageObject) -> str:
+    return extract_text(get_content_data(page)).replace('\n', '')
+
+
+class ContentStreamTableExtractor(PyPDFTableExtractor):
+    """ Like PyPDFTableExtractor but uses a faster text extraction """
+
+    def page_text(self, page: PageObject) -> str:
+        return extract_page_text(page)
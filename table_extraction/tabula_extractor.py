@@ -3,25 +3,35 @@ Table extractor based on Tabula. Not used anymore,
 but I'm leaving it here, just in case.
 """
 import json
+import os
 from bisect import bisect
 from pathlib import Path
 from typing import (
+    Any,
+    Iterable,
+    List,
     Optional,
     Tuple
 )
 
 import pandas as pd
 import tabula
+import tabula.io
 
+from file_index import load_json_or_empty, write_text_atomically
 from table_extraction.common import (
+    ExtractionOutcome,
+    ReportHandle,
     TableExtractor,
     find_table_page,
     TableExtractionError,
     COLUMNS,
-    CONVERTER_BY_COLUMN,
     cartesian_join,
+    convert_token_grid,
     COLUMN_PREFIXES,
     normalize_table,
+    open_report,
+    opened_report,
     sanity_check_with_totals
 )
 
@@ -32,8 +42,8 @@ def _load_tabula_templates(dirpath):
 
     Tabula templates are JSON files used to describe the location of the table
     inside a pdf report, i.e. the page and the selection area inside the page.
-    This script ignores the page, since it is automatically detected and make
-    use only of the selection area.
+    The page is used only as a hint (see TemplatePlans), since the actual page
+    is automatically detected.
 
     Tabula templates are generated with the Tabula app and saved in a sub-folder
     of the project with name "{date}.tabula-template.json" where {date} is the
@@ -47,38 +57,81 @@ def _load_tabula_templates(dirpath):
     return by_date
 
 
-def _tabula_template_getter(template_dir):
-    template_by_date = _load_tabula_templates(template_dir)
-    dates = sorted(template_by_date.keys())  # dates of first validity of the templates
+def _area_from_template(template):
+    return template['y1'], template['x1'], template['y2'], template['x2']
 
-    def get_tabula_template(report_date):
-        """ Returns the tabula template to use given the report date """
-        i = bisect(dates, report_date)  # index of 1st date >= report_date
-        template_date = dates[i - 1]
-        return template_by_date[template_date]
 
-    return get_tabula_template
+def _templates_stamp(dirpath) -> List[List]:
+    """ Names and modification times of the template files (to detect changes) """
+    return sorted([entry.name, entry.stat().st_mtime_ns] for entry in os.scandir(dirpath))
 
 
-def _area_from_template(template):
-    return template['y1'], template['x1'], template['y2'], template['x2']
+class TemplatePlans:
+    """
+    Tabula templates compiled into a lookup table: for the validity range
+    starting at dates[i], areas[i] is the area of the table and pages[i] is the
+    page where the table is expected to be (initially the page of the template,
+    then the last page where it was found).
 
+    Plans are cached (as compact JSON) in cache_path, so templates are parsed
+    again only when a template file is added, removed or modified.
+    """
 
-def extract_table(pdf_path,
-                  area: Tuple[float, float, float, float],
-                  page_number: Optional[int] = None) -> pd.DataFrame:
-    """ Returns the table in a pd.DataFrame """
-    if page_number is None:
-        _, page_number = find_table_page(pdf_path)
+    def __init__(self, dates: List[str], areas: List[Tuple[float, float, float, float]],
+                 pages: List[Optional[int]], stamp=None, cache_path=None):
+        self.dates = dates  # dates of first validity of the templates (sorted)
+        self.areas = areas
+        self.pages = pages
+        self.stamp = stamp
+        self.cache_path = cache_path
 
-    tables = tabula.read_pdf(
-        str(pdf_path), pages=page_number, area=area, multiple_tables=False,
-        pandas_options={'names': COLUMNS, 'converters': CONVERTER_BY_COLUMN})
-    if not tables:
-        raise TableExtractionError('tabula.read_pdf did not return anything')
+    @classmethod
+    def compile(cls, template_by_date, **kwargs) -> 'TemplatePlans':
+        dates = sorted(template_by_date)
+        return cls(dates,
+                   [_area_from_template(template_by_date[date]) for date in dates],
+                   [template_by_date[date].get('page') for date in dates],
+                   **kwargs)
+
+    @classmethod
+    def load(cls, template_dir, cache_path=None) -> 'TemplatePlans':
+        stamp = _templates_stamp(template_dir)
+        if cache_path is not None:
+            cached = load_json_or_empty(cache_path)
+            if cached and cached['stamp'] == stamp:
+                return cls(cached['dates'], [tuple(area) for area in cached['areas']],
+                           cached['pages'], stamp=stamp, cache_path=cache_path)
+        plans = cls.compile(_load_tabula_templates(template_dir),
+                            stamp=stamp, cache_path=cache_path)
+        plans.save()
+        return plans
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        plans = {'stamp': self.stamp, 'dates': self.dates, 'areas': self.areas, 'pages': self.pages}
+        write_text_atomically(self.cache_path, json.dumps(plans, separators=(',', ':')))
+
+    def lookup(self, report_date: str) -> int:
+        """ Returns the index of the plan to use given the report date """
+        i = bisect(self.dates, report_date)  # index of 1st date > report_date
+        if i == 0:
+            raise TableExtractionError('no tabula template for reports of ' + report_date)
+        return i - 1
+
+    def record_page(self, i: int, page_number: int):
+        """ Stores the page where the table was found, if it's not the expected one """
+        if self.pages[i] != page_number:
+            self.pages[i] = page_number
+            self.save()
+
+    def config(self) -> dict:
+        """ Returns the areas by date of first validity (pages don't affect tables) """
+        return dict(zip(self.dates, self.areas))
 
-    raw_df = tables[0]
 
+def _clean_raw_table(raw_df: pd.DataFrame) -> pd.DataFrame:
+    """ Fixes, checks and normalizes the table read by tabula (including the row of totals) """
     if len(raw_df) == 12:
         pass
     elif (
@@ -106,12 +159,144 @@ def extract_table(pdf_path,
     return table
 
 
+def extract_table(pdf_path,
+                  area: Tuple[float, float, float, float],
+                  page_number: Optional[int] = None) -> pd.DataFrame:
+    """ Returns the table in a pd.DataFrame """
+    report = open_report(pdf_path)
+    if page_number is None:
+        page_number = find_table_page(report).number
+
+    tables = tabula.read_pdf(
+        str(report.path), pages=page_number, area=area, multiple_tables=False,
+        pandas_options={'names': COLUMNS, 'dtype': str, 'keep_default_na': False})
+    if not tables:
+        raise TableExtractionError('tabula.read_pdf did not return anything')
+
+    return _clean_raw_table(convert_token_grid(tables[0].fillna('').to_numpy()))
+
+
+class TabulaSession:
+    """
+    Runs tabula-java inside a JVM started (once per process) with JPype, so that
+    many tables can be read paying the JVM startup only once, instead of once per
+    call as tabula.read_pdf does.
+
+    Tables are read like tabula.read_pdf(..., area=area, multiple_tables=False),
+    i.e. with the extraction method decided by tabula-java for each page area.
+    """
+    JAVA_OPTIONS = ('-Dfile.encoding=UTF8', '-Djava.awt.headless=true')
+
+    def __init__(self, jar_path: Optional[str] = None):
+        import jpype  # optional dependency, needed only by this class
+
+        if not jpype.isJVMStarted():
+            jar_path = jar_path or tabula.io._jar_path()
+            jpype.startJVM(*self.JAVA_OPTIONS, classpath=[jar_path], convertStrings=False)
+        self._File = jpype.JClass('java.io.File')
+        self._JByteArray = jpype.JArray(jpype.JByte)
+        self._PDDocument = jpype.JClass('org.apache.pdfbox.pdmodel.PDDocument')
+        self._ObjectExtractor = jpype.JClass('technology.tabula.ObjectExtractor')
+        self._basic_algorithm = jpype.JClass(
+            'technology.tabula.extractors.BasicExtractionAlgorithm')()
+        self._spreadsheet_algorithm = jpype.JClass(
+            'technology.tabula.extractors.SpreadsheetExtractionAlgorithm')()
+
+    def _load_document(self, report):
+        if isinstance(report, ReportHandle):  # already in memory: don't read the file again
+            return self._PDDocument.load(self._JByteArray(report.data[:]))
+        return self._PDDocument.load(self._File(str(report)))
+
+    def _read_rows(self, pdf_path, page_number: int, area) -> List[List[str]]:
+        document = self._load_document(pdf_path)
+        try:
+            page = self._ObjectExtractor(document).extract(page_number).getArea(*map(float, area))
+            algorithm = (self._spreadsheet_algorithm
+                         if self._spreadsheet_algorithm.isTabular(page)
+                         else self._basic_algorithm)
+            return [[str(cell.getText()) for cell in row]
+                    for table in algorithm.extract(page)
+                    for row in table.getRows()]
+        finally:
+            document.close()
+
+    def read_table(self, pdf_path, page_number: int, area) -> pd.DataFrame:
+        rows = self._read_rows(pdf_path, page_number, area)
+        if not rows:
+            raise TableExtractionError('tabula did not return anything')
+        return convert_token_grid(rows)
+
+    def read_tables(self, jobs: Iterable[Tuple[Any, int, Tuple]]) -> List[ExtractionOutcome]:
+        """
+        Reads the table of each (pdf_path, page_number, area) job; pdf_path can
+        be a ReportHandle
+        """
+        outcomes = []
+        for pdf_path, page_number, area in jobs:
+            try:
+                outcomes.append(ExtractionOutcome(
+                    self.read_table(pdf_path, page_number, area), {}, None))
+            except Exception as exc:
+                outcomes.append(ExtractionOutcome(None, {}, exc))
+        return outcomes
+
+
 class TabulaTableExtractor(TableExtractor):
+    """
+    If batched is True, extract_many() reads all tables in a single TabulaSession
+    (requires JPype). If plans_path is provided, the compiled templates (see
+    TemplatePlans) are cached in that file.
+    """
+
+    def __init__(self, template_dir, page_index=None, batched=False, plans_path=None):
+        self.plans = TemplatePlans.load(template_dir, plans_path)
+        self.page_index = page_index
+        self.batched = batched
+
+    def config(self) -> dict:
+        return {**super().config(), 'templates': self.plans.config()}
+
+    def _find_table(self, report, report_date: str, stats: Optional[dict] = None):
+        """ Returns the area and the page number of the table in the report """
+        i = self.plans.lookup(report_date)
+        page_number = self.find_table_page(report, stats, expected_page=self.plans.pages[i]).number
+        self.plans.record_page(i, page_number)
+        return self.plans.areas[i], page_number
+
+    def extract(self, path, report_date: str, stats: Optional[dict] = None) -> pd.DataFrame:
+        with opened_report(path) as report:
+            area, page_number = self._find_table(report, report_date, stats)
+        return extract_table(report.path, area, page_number)
+
+    def extract_many(self, items) -> List[ExtractionOutcome]:
+        if not self.batched:
+            return super().extract_many(items)
+
+        return self._extract_many_batched(items)
 
-    def __init__(self, template_dir):
-        self._get_template_by_date = _tabula_template_getter(template_dir)
+    def _extract_many_batched(self, items) -> List[ExtractionOutcome]:
+        outcomes: List[Optional[ExtractionOutcome]] = []
+        jobs = []
+        for path, report_date in items:
+            stats = {}
+            try:
+                # The report is closed as soon as the page is found, so that the
+                # number of open files doesn't grow with the number of reports
+                with opened_report(path) as report:
+                    area, page_number = self._find_table(report, report_date, stats)
+            except Exception as exc:
+                outcomes.append(ExtractionOutcome(None, stats, exc))
+            else:
+                outcomes.append(None)
+                jobs.append((len(outcomes) - 1, stats, (path, page_number, area)))
 
-    def extract(self, path, report_date: str) -> pd.DataFrame:
-        template = self._get_template_by_date(report_date)
-        area = _area_from_template(template)
-        return extract_table(path, area)
+        if jobs:
+            raw_outcomes = TabulaSession().read_tables(job for _, _, job in jobs)
+            for (i, stats, _), (raw_df, _, exc) in zip(jobs, raw_outcomes):
+                if exc is None:
+                    try:
+                        raw_df = _clean_raw_table(raw_df)
+                    except Exception as clean_exc:
+                        raw_df, exc = None, clean_exc
+                outcomes[i] = ExtractionOutcome(raw_df, stats, exc)
+        return outcomes
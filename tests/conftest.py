@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules of the project are top-level scripts, not a package
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,193 @@
+"""
+Tests of resumable downloads and conditional requests against a local HTTP server.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from download_reports import (
+    download_file,
+    download_missing_reports,
+    extract_report_urls_if_changed
+)
+from settings import get_report_path
+
+CONTENT = bytes(range(256)) * 64
+PAGE = b'<a href="bollettino/Bollettino-sorveglianza-integrata-COVID-19_2-aprile-2020.pdf">\n'
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.content = CONTENT
+        self.support_ranges = True
+        self.truncate_to = None  # if not None, the response ends after this many bytes
+        self.etag = '"v1"'
+        self.requests = []  # headers of each request
+
+    def url(self, path='/file.pdf'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        content = server.content
+        range_header = self.headers.get('Range')
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if range_header and server.support_ranges:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(content))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, len(content) - 1, len(content)))
+            body = content[start:]
+        else:
+            self.send_response(200)
+            body = content
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', server.etag)
+        self.end_headers()
+        if server.truncate_to is not None:
+            body = body[:server.truncate_to]
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def paths(tmp_path):
+    path = tmp_path / '2020-04-02.pdf'
+    return path, path.with_name(path.name + '.part')
+
+
+def test_download_from_scratch(server, paths):
+    path, part_path = paths
+    assert download_file(server.url(), path) == len(CONTENT)
+    assert path.read_bytes() == CONTENT
+    assert not part_path.exists()
+    assert 'Range' not in server.requests[0]
+
+
+def test_download_resumes_partial_file(server, paths):
+    path, part_path = paths
+    part_path.write_bytes(CONTENT[:1000])
+    assert download_file(server.url(), path) == len(CONTENT) - 1000
+    assert server.requests[0]['Range'] == 'bytes=1000-'
+    assert path.read_bytes() == CONTENT
+    assert not part_path.exists()
+
+
+def test_download_restarts_if_server_ignores_range(server, paths):
+    path, part_path = paths
+    server.support_ranges = False
+    part_path.write_bytes(b'x' * 1000)
+    assert download_file(server.url(), path) == len(CONTENT)
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_restarts_if_range_not_satisfiable(server, paths):
+    path, part_path = paths
+    part_path.write_bytes(b'x' * (len(CONTENT) + 10))  # e.g. the file changed on the server
+    assert download_file(server.url(), path) == len(CONTENT)
+    assert [request.get('Range') for request in server.requests] == [
+        'bytes=%d-' % (len(CONTENT) + 10), None]
+    assert path.read_bytes() == CONTENT
+
+
+def test_incomplete_download_is_resumed_next_time(server, paths):
+    path, part_path = paths
+    server.truncate_to = 3000
+    with pytest.raises(IOError, match='incomplete download'):
+        download_file(server.url(), path)
+    assert not path.exists()
+    assert part_path.read_bytes() == CONTENT[:3000]
+
+    server.truncate_to = None
+    download_file(server.url(), path)
+    assert server.requests[-1]['Range'] == 'bytes=3000-'
+    assert path.read_bytes() == CONTENT
+
+
+def test_conditional_request_of_unchanged_page(server):
+    server.content = PAGE
+    urls, state = extract_report_urls_if_changed(server.url('/news'))
+    assert len(urls) == 1 and urls[0].endswith('2-aprile-2020.pdf')
+    assert state['etag'] == server.etag
+
+    urls, new_state = extract_report_urls_if_changed(server.url('/news'), page_state=state)
+    assert server.requests[-1]['If-None-Match'] == server.etag
+    assert urls is None
+    assert new_state == state
+
+
+def test_page_with_new_etag_but_same_content_is_not_parsed(server):
+    server.content = PAGE
+    _, state = extract_report_urls_if_changed(server.url('/news'))
+    server.etag = '"v2"'
+    urls, new_state = extract_report_urls_if_changed(server.url('/news'), page_state=state)
+    assert urls is None
+    assert new_state['etag'] == '"v2"'
+
+
+def test_changed_page_is_parsed(server):
+    server.content = PAGE
+    _, state = extract_report_urls_if_changed(server.url('/news'))
+    server.etag = '"v2"'
+    server.content = PAGE + PAGE.replace(b'2-aprile', b'3-aprile')
+    urls, _ = extract_report_urls_if_changed(server.url('/news'), page_state=state)
+    assert len(urls) == 2
+
+
+def test_session_can_be_passed(server, paths):
+    path, _ = paths
+    with requests.Session() as session:
+        download_file(server.url(), path, session)
+    assert path.read_bytes() == CONTENT
+
+
+def test_scrape_state_is_updated_when_only_validators_change(server, tmp_path):
+    server.content = PAGE
+    get_report_path('2020-04-02', dirpath=tmp_path).write_bytes(CONTENT)  # nothing to download
+    state_path = tmp_path / 'state.json'
+
+    def download():
+        download_missing_reports(urls_by_date={}, scrape_url=server.url('/news'),
+                                 output_dir=tmp_path, state_path=state_path)
+        return json.loads(state_path.read_text())
+
+    old_state = download()
+    server.etag = '"v2"'
+    state = download()
+    assert state['page']['etag'] == '"v2"'
+    assert state['report_urls'] == old_state['report_urls']
+
+    download()
+    assert server.requests[-1]['If-None-Match'] == '"v2"'
+    assert len(server.requests) == 3
@@ -0,0 +1,13 @@
+"""
+update_data.py runs often (e.g. in a cronjob) and most runs find no new reports,
+so it must be fast to import: heavy modules are imported only when needed.
+"""
+from import_timing import measure_import
+
+MAX_IMPORT_SECONDS = 0.5  # ~0.1s on a laptop; pandas alone takes more than this
+
+
+def test_update_data_imports_no_heavy_modules():
+    result = measure_import('update_data')
+    assert result['heavy_modules'] == []
+    assert result['seconds'] < MAX_IMPORT_SECONDS
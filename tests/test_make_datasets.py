@@ -0,0 +1,92 @@
+"""
+Tests of make_datasets.py on synthetic reports (see benchmark.py).
+"""
+import pandas as pd
+import pytest
+
+from benchmark import make_synthetic_corpus
+from columnar import INDEX_NAMES, load_full_dataset
+from file_index import FileIndex
+from make_datasets import (
+    DatasetCreationError,
+    make_full_dataset,
+    make_single_date_datasets,
+    make_single_date_datasets_pipelined
+)
+from table_extraction.pypdf_extractor import PyPDFTableExtractor
+
+
+@pytest.fixture(scope='module')
+def reports(tmp_path_factory):
+    return make_synthetic_corpus(tmp_path_factory.mktemp('reports'), num_reports=3, num_pages=4)
+
+
+@pytest.fixture(scope='module')
+def by_date_dir(reports, tmp_path_factory):
+    dirpath = tmp_path_factory.mktemp('by-date')
+    make_single_date_datasets(reports[0][1].parent, dirpath, PyPDFTableExtractor())
+    return dirpath
+
+
+def make_full(by_date_dir, tmp_path, **kwargs):
+    return make_full_dataset(by_date_dir, tmp_path / 'data',
+                             manifest_path=tmp_path / 'manifest.json',
+                             digest_index=FileIndex(tmp_path / 'digests.json'),
+                             feather_path=tmp_path / 'cache' / 'full.feather', **kwargs)
+
+
+def test_pipelined_download_error_keeps_written_datasets(reports, tmp_path):
+    def report_paths():  # a downloader failing after two reports
+        for _, path in reports[:2]:
+            yield path
+        raise ConnectionError('connection lost')
+
+    with pytest.raises(DatasetCreationError) as exc_info:
+        make_single_date_datasets_pipelined(report_paths(), data_dir=tmp_path,
+                                            table_extractor=PyPDFTableExtractor())
+    error = exc_info.value
+    assert isinstance(error.stopped_by, ConnectionError)
+    assert error.__cause__ is error.stopped_by
+    assert error.errors == {}
+    assert [path.name for path in error.new_dataset_paths] == [
+        f'iccas_{date}.csv' for date, _ in reports[:2]]
+    assert all(path.exists() for path in error.new_dataset_paths)
+
+
+def test_partial_downloads_are_ignored(reports, tmp_path):
+    reports_dir = reports[0][1].parent
+    part_path = reports_dir / '2020-04-30.pdf.part'  # left by an interrupted download
+    part_path.write_bytes(b'%PDF-1.4\n')
+    try:
+        new_paths = make_single_date_datasets(reports_dir, tmp_path, PyPDFTableExtractor())
+    finally:
+        part_path.unlink()
+    assert [path.name for path in new_paths] == [f'iccas_{date}.csv' for date, _ in reports]
+
+
+def test_feather_copy_is_not_written_next_to_the_published_dataset(by_date_dir, tmp_path):
+    out_path = make_full(by_date_dir, tmp_path)
+    assert [path.name for path in out_path.parent.iterdir()] == [out_path.name]
+    full = pd.read_csv(out_path, index_col=INDEX_NAMES)
+    pd.testing.assert_frame_equal(load_full_dataset(tmp_path / 'cache' / 'full.feather'), full,
+                                  check_dtype=False)
+
+
+def test_incremental_full_dataset_without_new_dates_is_not_rewritten(by_date_dir, tmp_path):
+    out_path = make_full(by_date_dir, tmp_path)
+    feather_path = tmp_path / 'cache' / 'full.feather'
+    mtimes = out_path.stat().st_mtime_ns, feather_path.stat().st_mtime_ns
+    make_full(by_date_dir, tmp_path, incremental=True)
+    assert (out_path.stat().st_mtime_ns, feather_path.stat().st_mtime_ns) == mtimes
+
+    feather_path.unlink()
+    make_full(by_date_dir, tmp_path, incremental=True)
+    assert feather_path.exists()
+
+
+def test_unchanged_single_date_datasets_are_not_rewritten(reports, tmp_path, monkeypatch):
+    monkeypatch.setattr('os.linesep', '\r\n')  # like on Windows
+    reports_dir = reports[0][1].parent
+    assert len(make_single_date_datasets(reports_dir, tmp_path, PyPDFTableExtractor())) == 3
+    assert make_single_date_datasets(reports_dir, tmp_path, PyPDFTableExtractor(),
+                                     skip_existing=False) == []
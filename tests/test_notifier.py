@@ -0,0 +1,85 @@
+"""
+Tests of EmailSender and Notifier against an in-process SMTP stub.
+"""
+import socketserver
+import threading
+
+import pytest
+
+from update_data import EmailSender, Notifier
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """ Minimal SMTP server recording connections and received messages """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPStubHandler)
+        self.connections = 0
+        self.messages = []
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost SMTP stub')
+        for raw_line in self.rfile:
+            command = raw_line.decode('ascii').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    lines.append(data_line)
+                self.server.messages.append(b''.join(lines))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:  # MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def smtp_stub():
+    server = SMTPStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_notifier(smtp_stub) -> Notifier:
+    sender = EmailSender('bot@example.com', host='127.0.0.1',
+                         port=smtp_stub.server_address[1], starttls=False)
+    return Notifier(system=False, emails=['me@example.com'], email_sender=sender)
+
+
+def test_flush_without_emails_opens_no_connection(smtp_stub):
+    notifier = make_notifier(smtp_stub)
+    notifier.flush()
+    assert smtp_stub.connections == 0
+    assert notifier.email_sender._smtp is None
+
+
+def test_queued_emails_are_sent_over_one_connection(smtp_stub):
+    notifier = make_notifier(smtp_stub)
+    for i in range(3):
+        notifier.notify(f'Title {i}', f'Description {i}')
+    assert smtp_stub.connections == 0  # nothing is sent before flush()
+
+    notifier.flush()
+    assert smtp_stub.connections == 1
+    assert len(smtp_stub.messages) == 3
+    assert all(f'Subject: Title {i}'.encode() in msg for i, msg in enumerate(smtp_stub.messages))
+    assert notifier.queued_emails == []
+    assert notifier.email_sender._smtp is None  # the connection is closed after flushing
@@ -0,0 +1,62 @@
+"""
+ContentStreamTableExtractor must return the same text and tables of PyPDFTableExtractor.
+"""
+import pandas as pd
+import pytest
+from PyPDF3.generic import DecodedStreamObject, NameObject
+from PyPDF3.pdf import PageObject
+
+from benchmark import make_synthetic_corpus
+from table_extraction.common import ReportHandle
+from table_extraction.pypdf_extractor import PyPDFTableExtractor
+from table_extraction.stream_extractor import (
+    ContentStreamTableExtractor,
+    extract_page_text,
+    extract_text,
+    get_content_data
+)
+
+
+@pytest.fixture(scope='module')
+def reports(tmp_path_factory):
+    return make_synthetic_corpus(tmp_path_factory.mktemp('reports'), num_reports=10, num_pages=5)
+
+
+def make_page(content: bytes) -> PageObject:
+    stream = DecodedStreamObject()
+    stream.setData(content)
+    page = PageObject()
+    page[NameObject('/Contents')] = stream
+    return page
+
+
+def test_page_text_is_the_same_of_pypdf(reports):
+    for _, path in reports:
+        with ReportHandle(path) as report:
+            for number in range(1, report.num_pages + 1):
+                page = report.page(number)
+                expected = page.extractText()
+                assert extract_text(get_content_data(page)) == expected
+                assert extract_page_text(page) == expected.replace('\n', '')
+
+
+@pytest.mark.parametrize('content', [
+    rb'BT (escaped \(parens\) \101 \\) Tj ET',
+    b'BT (line \\\ncontinuation \\%) Tj (byte string\\n) Tj ET',
+    rb'BT [(kerned) -120 (text) 50] TJ T* (next line) Tj ET',
+    b"BT (quote) ' 1 2 (double quote) \" ET",
+    b'BT <48656c6c6f20776f726c64> Tj <feff00e8> Tj ET',
+    b'BT % comment (not text) Tj\n(after comment) Tj ET',
+    b'q BI /W 1 /H 1 /BPC 8 /CS /G ID \xff EI Q BT (after image) Tj ET',
+])
+def test_operators_are_handled_like_pypdf(content):
+    page = make_page(content)
+    assert extract_text(get_content_data(page)) == page.extractText()
+
+
+def test_tables_are_the_same_of_pypdf(reports):
+    pypdf_extractor = PyPDFTableExtractor()
+    stream_extractor = ContentStreamTableExtractor()
+    for date, path in reports:
+        pd.testing.assert_frame_equal(stream_extractor.extract(path, date),
+                                      pypdf_extractor.extract(path, date))
@@ -0,0 +1,38 @@
+"""
+Tests of the batched mode of TabulaTableExtractor with a fake TabulaSession (no JVM).
+"""
+import os
+
+import pytest
+
+from benchmark import make_synthetic_corpus, write_synthetic_tabula_template
+from table_extraction import tabula_extractor
+from table_extraction.common import ExtractionOutcome
+from table_extraction.tabula_extractor import TabulaTableExtractor
+
+
+def count_open_files() -> int:
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='requires /proc')
+def test_batched_extraction_keeps_no_report_open(tmp_path, monkeypatch):
+    reports = make_synthetic_corpus(tmp_path / 'reports', num_reports=5, num_pages=4)
+    write_synthetic_tabula_template(tmp_path / 'templates')
+    extractor = TabulaTableExtractor(tmp_path / 'templates', batched=True)
+    open_files_before = count_open_files()
+    read_jobs = []
+
+    class FakeTabulaSession:
+        def read_tables(self, jobs):
+            read_jobs.extend(jobs)
+            self.open_files = count_open_files()
+            return [ExtractionOutcome(None, {}, ValueError('not read')) for _ in read_jobs]
+
+    session = FakeTabulaSession()
+    monkeypatch.setattr(tabula_extractor, 'TabulaSession', lambda: session)
+    outcomes = extractor.extract_many([(path, date) for date, path in reports])
+
+    assert session.open_files == open_files_before
+    assert [(path, page) for path, page, _ in read_jobs] == [
+        (path, outcome.stats['table_page']) for (_, path), outcome in zip(reports, outcomes)]
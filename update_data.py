@@ -5,23 +5,36 @@ of success. Email and system notifications are sent in case of errors or success
 
 This script will run in a copy of the repository that I don't use for development
 and will be called by a bash/powershell script that executes "git pull" before
-running this script.
+running this script. With --daemon, the script keeps running and checks for new
+reports periodically instead.
 """
 import argparse
 import json
 import logging
 import smtplib
-import sys
+import time
 from email.message import EmailMessage
+from itertools import chain
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, List, Optional, Set
+
+# Only the modules needed for checking for new reports are imported here; heavy
+# modules (git, pandas, PyPDF3...) are imported when there's something to do.
+from download_reports import download_missing_reports, get_http_session
+from metrics import Metrics
+from settings import (
+    get_date_from_filename,
+    DATA_BY_DATE_DIR,
+    DATA_REPO,
+    ISS_REPORTS_DIR,
+    METRICS_PATH,
+    get_report_path
+)
 
-import git
-from pynotifier import Notification
 
-from download_reports import download_missing_reports
-from make_datasets import make_full_dataset, make_single_date_datasets
-from settings import get_date_from_filename, DATA_REPO
+if TYPE_CHECKING:
+    import git
+    from extraction_cache import ExtractionCache
 
 
 logging.basicConfig(
@@ -34,111 +47,351 @@ COMMIT_TEMPLATE = '[iccas-bot] Update ({date})'
 
 
 class EmailSender:
-    """ Wrapper of smtplib.SMTP for sending authenticated emails (bye default using GMail) """
-    def __init__(self, email, password, host='smtp.gmail.com', port=587):
+    """
+    Wrapper of smtplib.SMTP for sending authenticated emails (bye default using GMail).
+    The connection is opened when the first message is sent and kept open until quit().
+    If password is None, no login is done (e.g. for a local SMTP server).
+    """
+    def __init__(self, email, password=None, host='smtp.gmail.com', port=587, starttls=True):
         self.email = email
         self.password = password
-        self.smtp = smtp = smtplib.SMTP(host, port=port)
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.login(self.email, self.password)
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self._smtp: Optional[smtplib.SMTP] = None
 
-    def quit(self):
-        self.smtp.quit()
+    @property
+    def smtp(self) -> smtplib.SMTP:
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.host, port=self.port)
+            smtp.ehlo()
+            if self.starttls:
+                smtp.starttls()
+            if self.password is not None:
+                smtp.login(self.email, self.password)
+            self._smtp = smtp
+        return self._smtp
 
-    def send_message(self, msg: EmailMessage):
-        return self.smtp.send_message(msg)
+    def quit(self):
+        if self._smtp is not None:
+            self._smtp.quit()
+            self._smtp = None
 
-    def send_mail(self, recipients, subject, content):
+    def make_message(self, recipients, subject, content) -> EmailMessage:
         msg = EmailMessage()
         msg['From'] = self.email
         msg['To'] = recipients
         msg['Subject'] = subject
         msg.set_content(content)
-        return self.send_message(msg)
+        return msg
+
+    def send_message(self, msg: EmailMessage):
+        return self.smtp.send_message(msg)
+
+    def send_mail(self, recipients, subject, content):
+        return self.send_message(self.make_message(recipients, subject, content))
 
 
 class Notifier:
-    """ Send a system notification + optional email notifications """
+    """
+    Send a system notification + optional email notifications. Emails are queued
+    and sent by flush() using a single connection.
+    """
     def __init__(self, system=True, emails=(), email_sender: Optional[EmailSender] = None,
                  prefix: str = ''):
         self.system_notification_enabled = system
         self.prefix = prefix
         self.emails = emails
         self.email_sender = email_sender
+        self.queued_emails: List[EmailMessage] = []
         if self.emails and not self.email_sender:
             raise ValueError('you must pass an email_sender for sending emails')
 
-    def notify(self, title, description, duration=5, urgency=Notification.URGENCY_NORMAL,
+    def notify(self, title, description, duration=5, urgency=None,
                email_message: Optional[EmailMessage] = None):
         title = self.prefix + title
-        Notification(
-            title=title,
-            description=description,
-            duration=duration,
-            urgency=urgency
-        ).send()
+        if self.system_notification_enabled:
+            from pynotifier import Notification
+
+            if urgency is None:
+                urgency = Notification.URGENCY_NORMAL
+            Notification(
+                title=title,
+                description=description,
+                duration=duration,
+                urgency=urgency
+            ).send()
         if self.emails:
-            if email_message:
-                return self.email_sender.send_message(email_message)
-            else:
-                return self.email_sender.send_mail(self.emails, title, description)
+            if not email_message:
+                email_message = self.email_sender.make_message(self.emails, title, description)
+            self.queued_emails.append(email_message)
 
+    def flush(self):
+        """ Sends the queued emails (if any) using a single connection, then closes it """
+        if not self.queued_emails:
+            return
+        try:
+            while self.queued_emails:
+                self.email_sender.send_message(self.queued_emails[0])
+                self.queued_emails.pop(0)
+        finally:
+            self.email_sender.quit()
 
-def main(branch='master', push=False, emails_to_notify=[]):
-    creds = json.loads(CREDENTIALS_PATH.read_text())
-    email_sender = EmailSender(creds['EMAIL_ADDRESS'], creds['EMAIL_PASSWORD'])
-    notifier = Notifier(emails=emails_to_notify, email_sender=email_sender)
 
+def open_repo(branch='master') -> 'git.Repo':
+    import git
+
+    repo = git.Repo(DATA_REPO)
+    if repo.active_branch.name != branch:
+        raise Exception('dataset repository in unexpected branch. Expected: %s. Actual: %s'
+                        % (branch, repo.active_branch.name))
+    # Commits are made with the git executable, which (unlike GitPython) refuses to
+    # commit without a configured identity: fail now rather than after making datasets
     try:
-        logging.info('Opening and checking the repository...')
-        repo = git.Repo(DATA_REPO)
-        if repo.active_branch.name != branch:
-            raise Exception('dataset repository in unexpected branch. Expected: %s. Actual: %s'
-                            % (branch, repo.active_branch.name))
+        repo.git.var('GIT_COMMITTER_IDENT')
+    except git.GitCommandError:
+        raise Exception('git identity of the dataset repository not configured; run '
+                        '"git config user.name <name>" and "git config user.email <email>" '
+                        'in %s' % DATA_REPO)
+    return repo
+
+
+def _make_datasets_pipelined(metrics: Metrics, dates: Optional[Set[str]] = None, session=None,
+                             cache: Optional['ExtractionCache'] = None) -> List[Path]:
+    """
+    Makes the datasets of the reports to process (see update) while new reports
+    are being downloaded; each new report is processed as soon as it's downloaded
+    (see make_single_date_datasets_pipelined).
+    """
+    from download_reports import iter_downloaded_reports
+    from extraction_cache import ExtractionCache
+    from make_datasets import make_single_date_datasets_pipelined
+
+    pending_dates = _dates_without_dataset() if dates is None else set(dates)
+    report_paths = [get_report_path(date) for date in sorted(pending_dates)]
+    new_report_paths = iter_downloaded_reports(metrics=metrics, session=session)
+
+    def iter_new_report_paths():
+        for path in new_report_paths:
+            logging.info('New report downloaded: %s', path)
+            if dates is not None:
+                dates.add(get_date_from_filename(path.name))
+            yield path
+
+    return make_single_date_datasets_pipelined(
+        chain((path for path in report_paths if path.exists()), iter_new_report_paths()),
+        skip_existing=True, metrics=metrics, cache=cache or ExtractionCache())
+
 
+def update(repo: Optional['git.Repo'] = None, branch='master', push=False,
+           metrics: Optional[Metrics] = None, dates: Optional[Set[str]] = None, session=None,
+           cache: Optional['ExtractionCache'] = None, partitioned=False,
+           pipelined=False) -> Optional[str]:
+    """
+    Downloads new reports, makes the new datasets and commits (and optionally
+    pushes) them. Returns the commit message or None if no dataset was written.
+    If some datasets can't be made (or, in pipelined mode, a download fails), the
+    others are committed (and pushed) before re-raising the DatasetCreationError.
+
+    Reports are processed if they don't have a dataset yet or, if dates is not
+    None, only if they are new or their date is in dates; the dates of new
+    reports are added to the set (so that they can be processed again if
+    something fails).
+
+    If there are no reports to process, this function returns before importing
+    any heavy module or opening the repository (if repo is None).
+
+    If partitioned is True, the full and deltas datasets are also published
+    split in monthly partitions (see make_partitioned_full_dataset), so that
+    consumers can fetch only the partitions of the new dates and the manifests.
+
+    If pipelined is True, reports are processed while new reports are being
+    downloaded (see _make_datasets_pipelined); in this case, heavy modules are
+    imported and the repository is opened before knowing if there's anything to do.
+    """
+    metrics = metrics or Metrics()
+    if not pipelined:
         logging.info('Checking for new reports...')
-        new_report_paths = download_missing_reports()
+        with metrics.stage('download'):
+            new_report_paths = download_missing_reports(metrics=metrics, session=session)
         if not new_report_paths:
             logging.info('No new reports.')
         else:
             logging.info('New reports found: %s', ', '.join(map(str, new_report_paths)))
+        if dates is not None:
+            dates.update(get_date_from_filename(path.name) for path in new_report_paths)
+        else:
+            dates = _dates_without_dataset()
+        if not dates:
+            logging.info('No reports to process.')
+            return None
+
+    from extraction_cache import ExtractionCache
+    from make_datasets import (
+        DatasetCreationError,
+        make_deltas_dataset,
+        make_full_dataset,
+        make_partitioned_deltas_dataset,
+        make_partitioned_full_dataset,
+        make_single_date_datasets
+    )
+
+    if repo is None:
+        logging.info('Opening and checking the repository...')
+        with metrics.stage('open_repo'):
+            repo = open_repo(branch)
 
-        new_dataset_paths = make_single_date_datasets(skip_existing=True)
-        if not new_dataset_paths:
-            logging.info('No new datasets written. Exit.')
-            sys.exit(0)
-        logging.info('New datasets: %s', ', '.join(map(str, new_dataset_paths)))
+    # If some datasets can't be made, the ones that were made are committed anyway
+    # (otherwise they would be skipped by the next runs) and the error is re-raised
+    creation_error = None
+    try:
+        if pipelined:
+            with metrics.stage('download_and_extraction'):
+                new_dataset_paths = _make_datasets_pipelined(metrics, dates, session, cache)
+        else:
+            with metrics.stage('extraction'):
+                new_dataset_paths = make_single_date_datasets(
+                    skip_existing=True, metrics=metrics, cache=cache or ExtractionCache(),
+                    dates=dates)
+    except DatasetCreationError as exc:
+        creation_error = exc
+        new_dataset_paths = exc.new_dataset_paths
+    if not new_dataset_paths:
+        if creation_error is not None:
+            raise creation_error
+        logging.info('No new datasets written.')
+        return None
+    logging.info('New datasets: %s', ', '.join(map(str, new_dataset_paths)))
 
-        full_dataset_path = make_full_dataset()
+    with metrics.stage('full_dataset'):
+        full_dataset_paths = [make_full_dataset(incremental=True, metrics=metrics)]
+        if partitioned:
+            full_dataset_paths += make_partitioned_full_dataset(metrics=metrics)
+    with metrics.stage('deltas_dataset'):
+        deltas_dataset_paths = [make_deltas_dataset(metrics=metrics)]
+        if partitioned:
+            deltas_dataset_paths += make_partitioned_deltas_dataset(metrics=metrics)
 
-        # git add
-        files_to_add = [str(path) for path in new_dataset_paths + [full_dataset_path]]
+    with metrics.stage('git_commit'):
+        # git add (with the git executable, which updates only the entries of the
+        # given files, while repo.index rewrites the whole index in Python)
+        files_to_add = [str(path) for path in
+                        new_dataset_paths + full_dataset_paths + deltas_dataset_paths]
         logging.info('Command: git add %s', ' '.join(files_to_add))
-        repo.index.add(items=files_to_add)
+        repo.git.add('--all', '--', *files_to_add)
 
         # git commit
         latest_date = max(get_date_from_filename(path.name) for path in new_dataset_paths)
         commit_msg = COMMIT_TEMPLATE.format(date=latest_date)
         logging.info('Command: git commit -m %r', commit_msg)
-        repo.index.commit(commit_msg)
+        repo.git.commit('-m', commit_msg)
 
-        # git push
-        if push:
-            # TODO: handle push errors
-            refspec = '{0}:{0}'.format(branch)
-            logging.info('Command: git push %s', refspec)
+    # git push
+    if push:
+        # TODO: handle push errors
+        refspec = '{0}:{0}'.format(branch)
+        logging.info('Command: git push %s', refspec)
+        with metrics.stage('git_push'):
             repo.remote('origin').push(refspec=refspec)
-            notifier.notify('Pushed new ICCAS datasets', commit_msg)
-        else:
-            notifier.notify('New commit waiting for push', commit_msg)
+    if creation_error is not None:
+        raise creation_error
+    return commit_msg
+
+
+def _notify_update(notifier: Notifier, commit_msg: str, push: bool, metrics: Metrics):
+    if push:
+        notifier.notify('Pushed new ICCAS datasets', commit_msg + '\n\n' + metrics.summary())
+    else:
+        notifier.notify('New commit waiting for push', commit_msg + '\n\n' + metrics.summary())
+
+
+def main(branch='master', push=False, emails_to_notify=[], metrics_path=METRICS_PATH,
+         partitioned=False, pipelined=False):
+    creds = json.loads(CREDENTIALS_PATH.read_text())
+    email_sender = EmailSender(creds['EMAIL_ADDRESS'], creds['EMAIL_PASSWORD'])
+    notifier = Notifier(emails=emails_to_notify, email_sender=email_sender)
+    metrics = Metrics()
+
+    try:
+        commit_msg = update(branch=branch, push=push, metrics=metrics, partitioned=partitioned,
+                            pipelined=pipelined)
+        if commit_msg is not None:
+            _notify_update(notifier, commit_msg, push, metrics)
 
     except Exception as exc:
-        notifier.notify('Fatal error', repr(exc))
+        notifier.notify('Fatal error', repr(exc) + '\n\n' + metrics.summary())
         logging.exception('Exception was raised')
         raise
     finally:
-        email_sender.quit()
+        try:
+            notifier.flush()
+        finally:
+            if metrics_path:
+                metrics.write_json_lines(metrics_path)
+                logging.info('Metrics appended to %s', metrics_path)
+
+
+def _dates_without_dataset() -> Set[str]:
+    report_dates = {get_date_from_filename(path.name) for path in ISS_REPORTS_DIR.glob('*.pdf')}
+    dataset_dates = {get_date_from_filename(path.name) for path in DATA_BY_DATE_DIR.glob('*.csv')}
+    return report_dates - dataset_dates
+
+
+def run_daemon(branch='master', push=False, emails_to_notify=[], metrics_path=METRICS_PATH,
+               interval=600, max_interval=6 * 3600, partitioned=False, pipelined=False):
+    """
+    Runs an update every `interval` seconds until interrupted. The repository,
+    the HTTP session and the extraction cache are created once, and only new
+    reports are processed (plus the ones that failed or were never processed,
+    found listing the reports and datasets folders at each cycle, so that the
+    reports downloaded in a cycle that failed are not forgotten).
+
+    After a failure, the interval is doubled (up to max_interval) until an
+    update succeeds. Emails are sent at the end of each update; the SMTP
+    connection is closed after that, since an idle one would be closed by the server.
+    """
+    creds = json.loads(CREDENTIALS_PATH.read_text())
+    email_sender = EmailSender(creds['EMAIL_ADDRESS'], creds['EMAIL_PASSWORD'])
+    notifier = Notifier(emails=emails_to_notify, email_sender=email_sender)
+
+    from extraction_cache import ExtractionCache
+
+    logging.info('Opening and checking the repository...')
+    repo = open_repo(branch)
+    session = get_http_session(pool_maxsize=4)
+    cache = ExtractionCache()
+    pending_dates: Set[str] = set()
+    delay = interval
+    try:
+        while True:
+            metrics = Metrics()
+            try:
+                pending_dates |= _dates_without_dataset()
+                commit_msg = update(repo, branch=branch, push=push, metrics=metrics,
+                                    dates=pending_dates, session=session, cache=cache,
+                                    partitioned=partitioned, pipelined=pipelined)
+                pending_dates.clear()
+                delay = interval
+                if commit_msg is not None:
+                    _notify_update(notifier, commit_msg, push, metrics)
+            except Exception as exc:
+                delay = min(delay * 2, max_interval)
+                logging.exception('Exception was raised. Retrying in %d seconds', delay)
+                notifier.notify('Error (retrying in %d seconds)' % delay,
+                                repr(exc) + '\n\n' + metrics.summary())
+            finally:
+                try:
+                    notifier.flush()
+                except Exception:
+                    logging.exception('Unable to send the notification emails')
+                if metrics_path:
+                    metrics.write_json_lines(metrics_path)
+            logging.info('Next check in %d seconds', delay)
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        logging.info('Stopped')
+    finally:
+        session.close()
 
 
 if __name__ == '__main__':
@@ -150,6 +403,31 @@ if __name__ == '__main__':
         '--push', action='store_true', help='commit and push new/updated datasets')
     parser.add_argument(
         '--emails', nargs='*', default=[], help='email address(es) to notify')
+    parser.add_argument(
+        '--metrics', type=Path, default=METRICS_PATH,
+        help='JSON-lines file the metrics of the run are appended to')
+    parser.add_argument(
+        '--partitioned', action='store_true',
+        help='publish the full and deltas datasets split in monthly partitions too')
+    parser.add_argument(
+        '--pipelined', action='store_true',
+        help='make the datasets of new reports while other reports are being downloaded')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running, checking for new reports every --interval seconds')
+    parser.add_argument(
+        '--interval', type=int, default=600, help='seconds between checks in daemon mode')
+    parser.add_argument(
+        '--max-interval', type=int, default=6 * 3600,
+        help='max seconds between checks in daemon mode when retrying after errors')
 
     args = parser.parse_args()
-    main(branch=args.branch, push=args.push, emails_to_notify=args.emails)
+    if args.daemon:
+        run_daemon(branch=args.branch, push=args.push, emails_to_notify=args.emails,
+                   metrics_path=args.metrics, interval=args.interval,
+                   max_interval=args.max_interval, partitioned=args.partitioned,
+                   pipelined=args.pipelined)
+    else:
+        main(branch=args.branch, push=args.push, emails_to_notify=args.emails,
+             metrics_path=args.metrics, partitioned=args.partitioned,
+             pipelined=args.pipelined)
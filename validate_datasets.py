@@ -0,0 +1,200 @@
+"""
+Checks the consistency of all the datasets (without touching the reports):
+ - counts are non-negative and counts by sex don't exceed total counts;
+ - derived columns (percentages, fatality rates) match the recomputed ones;
+ - percentages of each date sum to ~100;
+ - cumulative counts of each age group don't decrease from a date to the next;
+ - the full dataset contains the same data of the single-date datasets.
+
+All violations are reported; when run as a script, the exit code is 1 if there
+is any violation.
+"""
+import sys
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional
+)
+
+import numpy
+import pandas as pd
+
+from columnar import INDEX_NAMES, INT_COLUMNS
+from make_datasets import list_datasets_by_date
+from settings import DATA_BY_DATE_DIR, get_full_dataset_path
+from table_extraction.common import compute_derived_columns, find_derived_columns_mismatches
+
+VIOLATION_COLUMNS = ['check', 'date', 'age_group', 'column', 'value', 'expected']
+
+
+def load_datasets_by_date(dirpath: Path = DATA_BY_DATE_DIR) -> pd.DataFrame:
+    """ Returns all single-date datasets stacked in a DataFrame indexed by (date, age_group) """
+    date_path_pairs = list_datasets_by_date(dirpath)
+    tables = [pd.read_csv(path, index_col='age_group') for _, path in date_path_pairs]
+    return pd.concat(tables, keys=[date for date, _ in date_path_pairs], names=INDEX_NAMES)
+
+
+def _violations(check: str, index: pd.MultiIndex, column, value, expected) -> pd.DataFrame:
+    violations = pd.DataFrame({'column': column, 'value': value, 'expected': expected},
+                              index=index).reset_index()
+    violations.insert(0, 'check', check)
+    return violations[VIOLATION_COLUMNS]
+
+
+def _stack(condition: pd.DataFrame, values: pd.DataFrame, expected) -> pd.DataFrame:
+    """ Returns (column, value, expected) for each True cell of condition, indexed like data """
+    rows, cols = numpy.nonzero(condition.to_numpy())
+    expected = numpy.broadcast_to(numpy.asarray(expected, dtype=object), condition.shape)
+    return pd.DataFrame({
+        'column': condition.columns[cols],
+        'value': values.to_numpy()[rows, cols],
+        'expected': expected[rows, cols],
+    }, index=condition.index[rows])
+
+
+def check_counts(data: pd.DataFrame) -> pd.DataFrame:
+    """ Counts must be non-negative; male + female counts must not exceed the total """
+    counts = data[INT_COLUMNS]
+    negative = _stack(counts < 0, counts, '>= 0')
+    by_sex = pd.DataFrame({
+        what: data[f'male_{what}'] + data[f'female_{what}'] for what in ['cases', 'deaths']
+    })
+    exceeding = _stack(by_sex > data[by_sex.columns], by_sex, '<= total')
+    exceeding['column'] = 'male_' + exceeding['column'] + ' + female_' + exceeding['column']
+    return pd.concat([
+        _violations('negative_count', negative.index, **negative),
+        _violations('sex_counts_exceed_total', exceeding.index, **exceeding),
+    ])
+
+
+def check_derived_columns(data: pd.DataFrame, atol=0.1) -> pd.DataFrame:
+    """ Percentages and fatality rates must match the ones computed from counts """
+    mismatches = find_derived_columns_mismatches(
+        data, compute_derived_columns(data, by='date'), atol=atol)
+    return _violations('derived_column', mismatches.index, mismatches['column'],
+                       mismatches['original'], mismatches['recomputed'])
+
+
+def check_percentage_sums(data: pd.DataFrame, atol=0.5) -> pd.DataFrame:
+    """
+    Percentages of cases and deaths must sum to ~100 over age groups (for each
+    date) and over sexes (for each row); zero totals are skipped
+    """
+    columns = [col for col in data.columns if col.endswith('_percentage') and
+               not col.startswith(('male_', 'female_'))]
+    counts = data[[col[:-len('_percentage')] for col in columns]]
+    sums = data[columns].groupby(level='date').sum()
+    totals = counts.groupby(level='date').sum()
+    bad = ~numpy.isclose(sums.to_numpy(), 100, atol=atol) & (totals.to_numpy() > 0)
+    by_date = _stack(pd.DataFrame(bad, index=sums.index, columns=sums.columns), sums, 100)
+    by_date.index = pd.MultiIndex.from_arrays([by_date.index, [None] * len(by_date)],
+                                              names=INDEX_NAMES)
+
+    sex_sums = pd.DataFrame({
+        what: data[f'male_{what}_percentage'] + data[f'female_{what}_percentage']
+        for what in ['cases', 'deaths']
+    })
+    sex_totals = pd.DataFrame({
+        what: data[f'male_{what}'] + data[f'female_{what}'] for what in ['cases', 'deaths']
+    })
+    bad = ~numpy.isclose(sex_sums, 100, atol=atol) & (sex_totals > 0)
+    by_sex = _stack(bad, sex_sums, 100)
+    by_sex['column'] = ('male_' + by_sex['column'] + '_percentage + female_'
+                        + by_sex['column'] + '_percentage')
+    return pd.concat([
+        _violations('percentages_sum_by_date', by_date.index, **by_date),
+        _violations('percentages_sum_by_sex', by_sex.index, **by_sex),
+    ])
+
+
+def check_cumulative_counts(data: pd.DataFrame) -> pd.DataFrame:
+    """ Counts of each age group must not decrease from a date to the next one """
+    counts = data[INT_COLUMNS].sort_index(level='date', sort_remaining=False)
+    previous = counts.groupby(level='age_group', sort=False).shift()
+    decreasing = _stack(counts < previous, counts, previous.where(counts < previous))
+    return _violations('decreasing_count', decreasing.index, **decreasing)
+
+
+def check_full_dataset(data: pd.DataFrame, full: pd.DataFrame) -> pd.DataFrame:
+    """ The full dataset must contain the same rows and values of the single-date datasets """
+    missing = data.index.difference(full.index)
+    extra = full.index.difference(data.index)
+    common = data.index.intersection(full.index)
+    columns = data.columns.intersection(full.columns)
+    a = data.loc[common, columns]
+    b = full.loc[common, columns]
+    different = ~numpy.isclose(b.to_numpy(dtype=float), a.to_numpy(dtype=float),
+                               rtol=0, atol=1e-9, equal_nan=True)
+    mismatches = _stack(pd.DataFrame(different, index=common, columns=columns), b, a)
+    return pd.concat([
+        _violations('full_dataset_missing_row', missing, None, None, None),
+        _violations('full_dataset_extra_row', extra, None, None, None),
+        _violations('full_dataset_missing_column', pd.MultiIndex.from_tuples(
+            [(None, None)] * len(data.columns.difference(full.columns)), names=INDEX_NAMES),
+            data.columns.difference(full.columns), None, None),
+        _violations('full_dataset_value', mismatches.index, **mismatches),
+    ])
+
+
+CHECKS: Dict[str, Callable[[pd.DataFrame], pd.DataFrame]] = {
+    'counts': check_counts,
+    'derived_columns': check_derived_columns,
+    'percentage_sums': check_percentage_sums,
+    'cumulative_counts': check_cumulative_counts,
+}
+
+
+def validate_datasets(input_dir: Path = DATA_BY_DATE_DIR,
+                      full_dataset_path: Optional[Path] = None,
+                      checks: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Runs the checks on all the single-date datasets in input_dir and, unless
+    full_dataset_path is False, compares them with the full dataset. Returns
+    a DataFrame with a row for each violation (see VIOLATION_COLUMNS).
+    """
+    data = load_datasets_by_date(input_dir)
+    violations = [CHECKS[name](data) for name in (checks or CHECKS)]
+    if full_dataset_path is not False:
+        full = pd.read_csv(full_dataset_path or get_full_dataset_path(), index_col=INDEX_NAMES)
+        violations.append(check_full_dataset(data, full))
+    return pd.concat(violations, ignore_index=True)
+
+
+def print_report(violations: pd.DataFrame, max_rows_per_check=50):
+    if violations.empty:
+        print('No violations found')
+        return
+    for check, group in violations.groupby('check', sort=False):
+        print(f'{check}: {len(group)} violation(s)')
+        print(group.drop(columns='check').head(max_rows_per_check).to_string(index=False))
+        if len(group) > max_rows_per_check:
+            print(f'... ({len(group) - max_rows_per_check} more)')
+        print()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--input-dir', type=Path, default=DATA_BY_DATE_DIR, help='folder of single-date datasets')
+    parser.add_argument(
+        '--full-dataset', type=Path, default=None, help='full dataset path (CSV)')
+    parser.add_argument(
+        '--no-full-dataset', action='store_true', help="don't check the full dataset")
+    parser.add_argument(
+        '--checks', nargs='*', choices=list(CHECKS), default=None,
+        help='checks to run (default: all)')
+    parser.add_argument(
+        '--output', type=Path, default=None, help='write all violations to this CSV file')
+    args = parser.parse_args()
+
+    violations = validate_datasets(
+        args.input_dir, False if args.no_full_dataset else args.full_dataset, args.checks)
+    print_report(violations)
+    if args.output:
+        violations.to_csv(args.output, index=False)
+        print('Violations written to', args.output)
+    sys.exit(1 if len(violations) else 0)